@@ -0,0 +1,68 @@
+"""
+Regression benchmark for the routing core.
+
+Runs CONVERSATIONS generated multi-turn sessions (ping, additions with and
+without slot prompts, alarms) concurrently through a router on a
+VirtualTimeLoop: no sockets and no real waiting, so the figure measures
+the framework itself.
+
+    python benchmarks/conversations.py --conversations 5000 --rounds 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import suzie.plugins  # noqa: E402
+import suzie.testing  # noqa: E402
+
+
+def generate(rng, turns):
+    script = []
+    for _ in range(turns):
+        kind = rng.randrange(4)
+        if kind == 0:
+            script.append('ping')
+        elif kind == 1:
+            script.append('{} + {}'.format(rng.randrange(100),
+                                           rng.randrange(100)))
+        elif kind == 2:
+            script.extend(['add', str(rng.randrange(100)),
+                           str(rng.randrange(100))])
+        else:
+            script.append('beep in {}'.format(rng.randrange(1, 3600)))
+
+    # Stay around for the alarms
+    script.append(3600)
+    return script
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    scripts = [generate(rng, args.turns) for _ in range(args.conversations)]
+    plugins = [suzie.plugins.Ping(), suzie.plugins.Addition(),
+               suzie.plugins.Alarm()]
+
+    for n in range(args.rounds):
+        t0 = time.perf_counter()
+        uis = suzie.testing.converse(plugins, *scripts)
+        elapsed = time.perf_counter() - t0
+
+        messages = sum(len(ui.transcript) for ui in uis)
+        print('round {}  {:8.0f} conversations/s  {:8.0f} messages/s'.format(
+            n, len(uis) / elapsed, messages / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+TCP throughput and latency across event loop implementations.
+
+For every available loop (stock asyncio, uvloop if installed) starts a
+router with the Ping plugin behind a TCPServer on an ephemeral port and
+runs CLIENTS concurrent connections doing REQUESTS round trips each,
+alternating 'ping' and 'echo <payload>'.
+
+    python benchmarks/loop_bench.py --clients 50 --requests 500
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import suzie  # noqa: E402
+import suzie.loops  # noqa: E402
+import suzie.plugins  # noqa: E402
+from suzie.__main__ import TCPServer  # noqa: E402
+
+
+async def client(port, requests, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = [b'ping\n', b'echo ' + b'x' * 64 + b'\n']
+
+    for i in range(requests):
+        t0 = time.perf_counter()
+        writer.write(lines[i % 2])
+        await reader.readline()
+        latencies.append(time.perf_counter() - t0)
+
+    writer.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    router = suzie.Router(loop=loop, linger=True)
+    router.load(suzie.plugins.Ping)
+
+    server = TCPServer('127.0.0.1', 0, router=router, loop=loop)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+
+    latencies = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        client(port, args.requests, latencies)
+        for _ in range(args.clients)])
+    elapsed = time.perf_counter() - t0
+
+    server.close()
+    await router.shutdown(timeout=0)
+
+    return len(latencies) / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--loop', action='append',
+                        help='Loop implementation to test (default: all '
+                             'available)')
+    args = parser.parse_args()
+
+    for name in args.loop or suzie.loops.available():
+        factory = suzie.loops.loop_factory(name)
+        with asyncio.Runner(loop_factory=factory) as runner:
+            throughput, latencies = runner.run(run(args))
+
+        print('{:8} {:8.0f} req/s  p50 {:7.3f} ms  p99 {:7.3f} ms'.format(
+            name, throughput,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Memory cost of a TCP session, measured with tracemalloc.
+
+Opens SESSIONS connections to a TCPServer over socket pairs (the client
+ends are plain sockets allocated before tracing starts, so only the
+server side is measured) and reports traced bytes per session:
+
+- idle: connected, one request answered ('ping'), waiting for input
+- active: subscribed to a topic that got a broadcast (push queue and
+  task) and halfway through a slotted conversation ('add')
+
+    python benchmarks/session_footprint.py --sessions 2000
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import socket
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import suzie  # noqa: E402
+import suzie.plugins  # noqa: E402
+from suzie.__main__ import TCPServer  # noqa: E402
+
+
+async def request(loop, socks, line, replies=1):
+    for sock in socks:
+        await loop.sock_sendall(sock, line)
+
+    for sock in socks:
+        data = b''
+        while data.count(b'\n') < replies:
+            data += await loop.sock_recv(sock, 4096)
+
+
+def traced():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    router = suzie.Router(loop=loop, linger=True)
+    for plugin_cls in [suzie.plugins.Ping, suzie.plugins.Addition,
+                       suzie.plugins.Subscriptions]:
+        router.load(plugin_cls)
+    server = TCPServer('127.0.0.1', 0, router=router, loop=loop)
+
+    pairs = [socket.socketpair() for _ in range(args.sessions)]
+    clients = [client for (_, client) in pairs]
+    for client in clients:
+        client.setblocking(False)
+
+    tracemalloc.start()
+    base = traced()
+
+    for (sock, _) in pairs:
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader,
+                                                server._accept_client)
+        await loop.connect_accepted_socket(lambda: protocol, sock=sock)
+
+    await request(loop, clients, b'ping\n')
+    idle = traced()
+
+    await request(loop, clients, b'suscribe news\n')
+    router.publish('news', 'extra')
+    await request(loop, clients, b'add\n', replies=2)
+    active = traced()
+
+    tracemalloc.stop()
+
+    print('sessions {}'.format(args.sessions))
+    print('idle     {:8.0f} bytes/session'.format(
+        (idle - base) / args.sessions))
+    print('active   {:8.0f} bytes/session'.format(
+        (active - base) / args.sessions))
+
+    for client in clients:
+        client.close()
+    await router.shutdown(timeout=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=2000)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
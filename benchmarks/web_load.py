@@ -0,0 +1,133 @@
+"""
+Load test for the WebSocket and long-poll user interfaces.
+
+Starts a router with the Ping plugin and a WebServer on an ephemeral port
+and runs CLIENTS concurrent clients doing REQUESTS ping/pong round trips
+each, for every transport.
+
+    python benchmarks/web_load.py --clients 50 --requests 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import suzie  # noqa: E402
+import suzie.plugins  # noqa: E402
+import suzie.web  # noqa: E402
+
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length = 0
+
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+
+        key, _, value = line.partition(':')
+        if key.lower() == 'content-length':
+            length = int(value)
+
+    body = await reader.readexactly(length) if length else b''
+    return status, body
+
+
+def http_request(method, path, body=b''):
+    head = '{} {} HTTP/1.1\r\nHost: bench\r\nContent-Length: {}\r\n\r\n'
+    return head.format(method, path, len(body)).encode('latin-1') + body
+
+
+async def websocket_client(port, requests, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(
+        b'GET /ws HTTP/1.1\r\nHost: bench\r\nUpgrade: websocket\r\n'
+        b'Connection: Upgrade\r\nSec-WebSocket-Key: YmVuY2htYXJrYmVuY2g=\r\n'
+        b'Sec-WebSocket-Version: 13\r\n\r\n')
+    await read_response(reader)
+
+    frame = suzie.web.encode_frame(suzie.web.OP_TEXT, b'ping',
+                                   mask=os.urandom(4))
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        writer.write(frame)
+        await suzie.web.read_frame(reader)
+        latencies.append(time.perf_counter() - t0)
+
+    writer.write(suzie.web.encode_frame(suzie.web.OP_CLOSE, b'',
+                                        mask=os.urandom(4)))
+    writer.close()
+
+
+async def longpoll_client(port, requests, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(http_request('POST', '/sessions'))
+    _, body = await read_response(reader)
+    path = '/sessions/' + json.loads(body)['session']
+
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        writer.write(http_request('POST', path, b'ping'))
+        await read_response(reader)
+
+        frames = []
+        while not frames:
+            writer.write(http_request('GET', path + '?timeout=5'))
+            _, body = await read_response(reader)
+            frames = json.loads(body)
+        latencies.append(time.perf_counter() - t0)
+
+    writer.write(http_request('DELETE', path))
+    await read_response(reader)
+    writer.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    router = suzie.Router(loop=loop, linger=True)
+    router.load(suzie.plugins.Ping)
+
+    server = suzie.web.WebServer('127.0.0.1', 0, router=router, loop=loop)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+
+    for (name, client) in [('websocket', websocket_client),
+                           ('long-poll', longpoll_client)]:
+        latencies = []
+        t0 = time.perf_counter()
+        await asyncio.gather(*[
+            client(port, args.requests, latencies)
+            for _ in range(args.clients)])
+        elapsed = time.perf_counter() - t0
+
+        print('{:10} {:8.0f} req/s  p50 {:7.3f} ms  p99 {:7.3f} ms'.format(
+            name, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000))
+
+    server.close()
+    await router.shutdown(timeout=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ class Probability:
 
 class Aemet:
     BASE_URL = 'http://www.aemet.es/xml/municipios/localidad_{loc}.xml'
+    TIMEOUT = 10
 
     def __init__(self):
         self.location = 12040
@@ -30,11 +31,14 @@ class Aemet:
 
     def get_xml(self):
         if self._xml is None:
-            with request.urlopen(self.url) as fh:
+            with request.urlopen(self.url, timeout=self.TIMEOUT) as fh:
                 self._xml = fh.read().decode('iso-8859-15')
 
         return self._xml
 
+    def clear(self):
+        self._xml = None
+
     def info(self, when=When.TODAY):
         now = datetime.datetime.now()
         if when == When.TODAY:
@@ -63,7 +67,7 @@ class Aemet:
             start = int(start)
             end = int(end)
 
-            if when == self.When.TODAY and now.hour > end:
+            if when == When.TODAY and now.hour > end:
                 continue
 
             probabilities.append((start, end, int(e.text)))
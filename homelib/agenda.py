@@ -0,0 +1,216 @@
+import bisect
+import collections
+import datetime
+import os
+
+from . import journal
+
+
+Appointment = collections.namedtuple(
+    'Appointment', ['id', 'user', 'start', 'end', 'about', 'where'])
+
+
+class ConflictError(ValueError):
+    def __init__(self, conflicts):
+        super().__init__(conflicts)
+        self.conflicts = conflicts
+
+
+class _UserIndex:
+    def __init__(self):
+        # Sorted (start, id) pairs of appointments up to Agenda.SHORT long
+        self.starts = []
+        # Longer ones, few and always checked
+        self.long = set()
+
+
+class Agenda(journal.Journal):
+    """
+    Appointments per user in a start-sorted index.
+
+    An appointment up to SHORT long overlapping [start, end) can't start
+    before start - SHORT, so overlap, range and "next" queries are a
+    binary search plus a scan over actual candidates; the (rare) longer
+    ones are kept apart and always checked.
+
+    With `path` changes are persisted as records appended to that log
+    (see journal.Journal): add() and remove() return once theirs is
+    written, and undo the change if it can't be. The index is updated
+    right away so concurrent bookings see each other.
+    """
+    SHORT = datetime.timedelta(days=1)
+
+    def __init__(self, path=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.appointments = {}
+        self._users = collections.defaultdict(_UserIndex)
+        self._next_id = 1
+        # Changes in the index but not in the log yet
+        self._adding = set()
+        self._removing = {}
+
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self.appointments)
+
+    @staticmethod
+    def _record(appt):
+        return dict(appt._asdict(), op='add', start=appt.start.isoformat(),
+                    end=appt.end.isoformat())
+
+    def _index(self, appt):
+        self.appointments[appt.id] = appt
+        index = self._users[appt.user]
+        if appt.end - appt.start > self.SHORT:
+            index.long.add(appt.id)
+        else:
+            bisect.insort(index.starts, (appt.start, appt.id))
+
+    def _unindex(self, appt):
+        del(self.appointments[appt.id])
+        index = self._users[appt.user]
+        if appt.id in index.long:
+            index.long.discard(appt.id)
+        else:
+            starts = index.starts
+            del(starts[bisect.bisect_left(starts, (appt.start, appt.id))])
+
+    async def add(self, user, start, end, about, where,
+                  allow_conflicts=False):
+        if end <= start:
+            raise ValueError(end)
+
+        if not allow_conflicts:
+            conflicts = self.between(user, start, end)
+            if conflicts:
+                raise ConflictError(conflicts)
+
+        appt = Appointment(self._next_id, user, start, end, about, where)
+        self._next_id += 1
+        self._index(appt)
+        if self.path is None:
+            return appt
+
+        self._adding.add(appt.id)
+        try:
+            await self._commit(self._record(appt))
+        except Exception:
+            self._adding.discard(appt.id)
+            self._unindex(appt)
+            raise
+
+        return appt
+
+    async def remove(self, appt_id):
+        appt = self.appointments[appt_id]
+        self._unindex(appt)
+        if self.path is None:
+            return appt
+
+        self._removing[appt.id] = appt
+        try:
+            await self._commit({'op': 'del', 'id': appt.id})
+        except Exception:
+            del(self._removing[appt.id])
+            self._index(appt)
+            raise
+
+        return appt
+
+    def between(self, user, start, end):
+        index = self._users.get(user)
+        if index is None:
+            return []
+
+        lo = bisect.bisect_left(index.starts, (start - self.SHORT,))
+        hi = bisect.bisect_left(index.starts, (end,))
+
+        ret = []
+        for (_, appt_id) in index.starts[lo:hi]:
+            appt = self.appointments[appt_id]
+            if appt.end > start:
+                ret.append(appt)
+
+        for appt_id in index.long:
+            appt = self.appointments[appt_id]
+            if appt.start < end and appt.end > start:
+                ret.append(appt)
+
+        return sorted(ret, key=lambda a: (a.start, a.id))
+
+    def upcoming(self, user, now, n=1):
+        index = self._users.get(user)
+        if index is None:
+            return []
+
+        lo = bisect.bisect_left(index.starts, (now,))
+        found = [self.appointments[appt_id]
+                 for (_, appt_id) in index.starts[lo:lo + n]]
+        found.extend(self.appointments[appt_id] for appt_id in index.long
+                     if self.appointments[appt_id].start >= now)
+
+        return sorted(found, key=lambda a: (a.start, a.id))[:n]
+
+    # Journal
+
+    def _apply(self, record):
+        if record['op'] == 'add':
+            if record['id'] in self.appointments:
+                # Already there from a compaction
+                return
+
+            appt = Appointment(
+                record['id'], record['user'],
+                datetime.datetime.fromisoformat(record['start']),
+                datetime.datetime.fromisoformat(record['end']),
+                record['about'], record['where'])
+            self._index(appt)
+            self._next_id = max(self._next_id, appt.id + 1)
+
+        elif record['op'] == 'del':
+            appt = self.appointments.get(record['id'])
+            if appt is not None:
+                self._unindex(appt)
+
+        else:
+            raise ValueError(record)
+
+    def _written(self, record):
+        if record['op'] == 'add':
+            self._adding.discard(record['id'])
+        else:
+            self._removing.pop(record['id'], None)
+
+    def _live(self):
+        return len(self.appointments) - len(self._adding) + len(
+            self._removing)
+
+    def _snapshot(self):
+        appts = [appt for appt in self.appointments.values()
+                 if appt.id not in self._adding]
+        appts.extend(self._removing.values())
+        return [self._record(appt) for appt in appts]
+
+
+_default = None
+_agendas = {}
+
+
+def default_agenda():
+    global _default
+
+    if _default is None:
+        _default = Agenda()
+
+    return _default
+
+
+def open_agenda(path, **kwargs):
+    path = os.path.abspath(path)
+    if path not in _agendas:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _agendas[path] = Agenda(path, **kwargs)
+
+    return _agendas[path]
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+
+
+class Journal:
+    """
+    State kept in memory and persisted as an append-only log of JSON
+    records.
+
+    The log is only read at startup, every record through _apply().
+    Writes are grouped: records are buffered and written with a single
+    fsync every `commit_interval` seconds or `max_batch` records, whatever
+    comes first, in the loop's executor. The log is rewritten from
+    _snapshot() once records no longer live (_live()) are more than
+    `compact_ratio` of it.
+
+    Subclasses implement _apply(), _live() and _snapshot(), and may
+    override _written(), called for every record once it is in the log;
+    its return value is what _commit() resolves to.
+    """
+    def __init__(self, path, loop=None, commit_interval=0.05, max_batch=256,
+                 compact_ratio=0.5, compact_min=1024):
+        self.path = path
+        self.loop = loop
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+
+        self._records = 0
+        self._pending = []
+        self._waiters = []
+        self._timer = None
+        self._flushing = None
+
+    def _load(self):
+        try:
+            fh = open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+
+        with fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the log
+                    continue
+
+                self._apply(record)
+                self._records += 1
+
+    def _apply(self, record):
+        raise NotImplementedError()
+
+    def _live(self):
+        raise NotImplementedError()
+
+    def _snapshot(self):
+        raise NotImplementedError()
+
+    def _written(self, record):
+        return None
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop
+
+    def _commit(self, record):
+        loop = self._get_loop()
+        fut = loop.create_future()
+        self._pending.append(record)
+        self._waiters.append(fut)
+
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(self.commit_interval)
+
+        return fut
+
+    def _schedule_flush(self, delay):
+        if self._flushing is not None:
+            # The running flush picks up whatever is pending when done
+            return
+
+        if self._timer is not None:
+            if delay:
+                return
+            self._timer.cancel()
+
+        self._timer = self._get_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        self._flushing = self._get_loop().create_task(self._flush())
+
+    async def _flush(self):
+        loop = self._get_loop()
+
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                waiters, self._waiters = self._waiters, []
+
+                try:
+                    await loop.run_in_executor(None, self._write, batch)
+                except Exception as e:
+                    for fut in waiters:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    continue
+
+                self._records += len(batch)
+                for (record, fut) in zip(batch, waiters):
+                    result = self._written(record)
+                    if not fut.done():
+                        fut.set_result(result)
+
+                if self._needs_compaction():
+                    records = self._snapshot()
+                    await loop.run_in_executor(None, self._compact, records)
+
+        finally:
+            self._flushing = None
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._start_flush()
+
+        if self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    def _write(self, batch):
+        data = ''.join(json.dumps(r, ensure_ascii=False) + '\n'
+                       for r in batch)
+        with open(self.path, 'a', encoding='utf-8') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _needs_compaction(self):
+        if self._records < self.compact_min:
+            return False
+
+        dead = self._records - self._live()
+        return dead / self._records > self.compact_ratio
+
+    def _compact(self, records):
+        tmp = self.path + '.compact'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            for record in records:
+                fh.write(json.dumps(record, ensure_ascii=False) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.replace(tmp, self.path)
+        self._records = len(records)
@@ -0,0 +1,118 @@
+import collections
+import os
+import re
+import time
+
+from . import journal
+
+
+Note = collections.namedtuple('Note', ['id', 'user', 'ts', 'text'])
+
+
+def tokenize(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+class NoteStore(journal.Journal):
+    """
+    Per user notes kept in an append-only log (see journal.Journal).
+
+    Everything is indexed in memory (recent notes per user and an inverted
+    index of words). Records reach the index once written; the log is
+    compacted without deleted notes.
+    """
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+
+        self.notes = {}
+        self._by_user = collections.defaultdict(list)
+        self._index = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+        self._next_id = 1
+
+        self._load()
+
+    def _apply(self, record):
+        if record['op'] == 'add':
+            if record['id'] in self.notes:
+                # Already there from a compaction
+                return self.notes[record['id']]
+
+            note = Note(record['id'], record['user'], record['ts'],
+                        record['text'])
+            self.notes[note.id] = note
+            self._by_user[note.user].append(note.id)
+            for token in tokenize(note.text):
+                self._index[note.user][token].add(note.id)
+            self._next_id = max(self._next_id, note.id + 1)
+            return note
+
+        elif record['op'] == 'del':
+            note = self.notes.pop(record['id'], None)
+            if note is None:
+                return None
+
+            self._by_user[note.user].remove(note.id)
+            index = self._index[note.user]
+            for token in tokenize(note.text):
+                index[token].discard(note.id)
+                if not index[token]:
+                    del(index[token])
+            return note
+
+        raise ValueError(record)
+
+    async def add(self, user, text):
+        record = {'op': 'add', 'id': self._next_id, 'user': user,
+                  'ts': time.time(), 'text': text}
+        # Taken now, concurrent adds are written before any is applied
+        self._next_id += 1
+        return await self._commit(record)
+
+    async def delete(self, user, note_id):
+        note = self.notes.get(note_id)
+        if note is None or note.user != user:
+            raise KeyError(note_id)
+
+        await self._commit({'op': 'del', 'id': note_id})
+        return note
+
+    def recent(self, user, n=10):
+        ids = self._by_user.get(user, [])[-n:]
+        return [self.notes[i] for i in reversed(ids)]
+
+    def search(self, user, query, limit=10):
+        tokens = tokenize(query)
+        index = self._index.get(user)
+        if not tokens or not index:
+            return []
+
+        sets = sorted((index.get(t, set()) for t in tokens), key=len)
+        ids = set.intersection(*sets)
+        return [self.notes[i] for i in sorted(ids, reverse=True)[:limit]]
+
+    # Journal
+
+    def _written(self, record):
+        # Only what is in the log gets indexed
+        return self._apply(record)
+
+    def _live(self):
+        return len(self.notes)
+
+    def _snapshot(self):
+        return [{'op': 'add', 'id': note.id, 'user': note.user,
+                 'ts': note.ts, 'text': note.text}
+                for note in self.notes.values()]
+
+
+_stores = {}
+
+
+def open_store(path, **kwargs):
+    path = os.path.abspath(path)
+    if path not in _stores:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _stores[path] = NoteStore(path, **kwargs)
+
+    return _stores[path]
@@ -1,53 +1,96 @@
 import abc
 import asyncio
-import collections
-import re
+import importlib
+import inspect
+import itertools
 import logging
+import os
+import re
+import sys
+import time
 
-from . import exc
+from . import (breaker, bus, cache, exc, logs, scheduler, supervisor,
+               timers, triggers)
 
 
 ACTIVE_SLOT = 'slots.active-slot'
 SLOTS_PREFIX = 'slots.slot-'
 
 
-class Message(collections.UserString):
-    def __init__(self, text):
-        text = re.sub(r'\s+', ' ', text).strip()
-        super().__init__(text)
+class Message(str):
+    __slots__ = ()
+
+    def __new__(cls, text='', *args, **kwargs):
+        return super().__new__(cls, re.sub(r'\s+', ' ', str(text)).strip())
 
 
 class RequestMessage(Message):
     def __init__(self, text, what):
-        super().__init__(text)
         self.what = what
 
 
 class ClosingMessage(Message):
-    def __init__(self, text='Done!'):
-        super().__init__(text)
+    __slots__ = ()
+
+    def __new__(cls, text='Done!'):
+        return super().__new__(cls, text)
+
+
+class Broadcast(Message):
+    def __init__(self, text, topic):
+        self.topic = topic
+        self.line = (self + '\n').encode('utf-8')
 
 
 class Plugin:
     WEIGHT = 0
     TRIGGERS = []
     SLOTS = []
+    # Set CACHE_TTL (seconds) to memoize main() results per slot values
+    CACHE_TTL = None
+    CACHE_SIZE = 128
+    # Execution deadline in seconds, None uses the router's default
+    TIMEOUT = None
+    FALLBACK = "[!] I can't do that right now, try again later"
+    # (rate per second, burst) shared by all sessions, None for no limit
+    RATE_LIMIT = None
+    # Refuse triggers prone to exponential backtracking
+    STRICT_TRIGGERS = True
 
     def __init__(self, logger=None):
         if not self.TRIGGERS:
             errmsg = "No triggers defined"
             raise TypeError(errmsg)
 
+        self.logger = logger or logging.getLogger(self.NAME)
+
+        for trigger in self.__class__.TRIGGERS:
+            self.check_trigger(trigger)
+
         self.triggers = [
-            re.compile(trigger, re.IGNORECASE)
+            triggers.compile(trigger, re.IGNORECASE)
             for trigger in self.__class__.TRIGGERS]
 
-        self.logger = None or logging.getLogger(self.NAME)
+        self.cache = None
+        if self.CACHE_TTL is not None:
+            self.cache = cache.ResultCache(ttl=self.CACHE_TTL,
+                                           maxsize=self.CACHE_SIZE)
 
     @property
     def NAME(self):
         return self.__class__.__name__.split('.')[-1]
 
+    def check_trigger(self, trigger):
+        for (severity, problem) in triggers.analyze(trigger, re.IGNORECASE):
+            errmsg = "Trigger {trigger!r} of {plugin}: {problem}"
+            errmsg = errmsg.format(trigger=trigger, plugin=self.NAME,
+                                   problem=problem)
+
+            if severity == triggers.EXPONENTIAL and self.STRICT_TRIGGERS:
+                raise exc.UnsafeTrigger(errmsg)
+
+            self.logger.warning(errmsg)
+
     def matches(self, text):
         for trigger in self.triggers:
             m = trigger.search(text)
@@ -64,6 +107,20 @@ class Plugin:
     def handle(self, context, message):
         raise NotImplementedError()
 
+    def cache_key(self, **slots):
+        return tuple(sorted(slots.items()))
+
+    def call_main(self, context, **slots):
+        if self.cache is None:
+            return self.main(context, **slots)
+
+        key = self.cache_key(**slots)
+        if inspect.iscoroutinefunction(self.main):
+            return self.cache.call_async(
+                key, lambda: self.main(context, **slots))
+
+        return self.cache.call(key, lambda: self.main(context, **slots))
+
     @abc.abstractmethod
     def main(self, context, **kwargs):
         raise NotImplementedError()
@@ -136,59 +193,324 @@ class SlottedPlugin(Plugin):
         }
 
         # Check for missing slots and ask for one or run Plugin.main
-        missing = set(self.SLOTS) - set(slots.keys())
+        missing = [slot for slot in self.SLOTS if slot not in slots]
         if missing:
-            context.memory[ACTIVE_SLOT] = missing.pop()
+            context.memory[ACTIVE_SLOT] = missing[0]
             msg = "Give " + context.memory[ACTIVE_SLOT]
-            return Message(msg)
+            return RequestMessage(msg, what=context.memory[ACTIVE_SLOT])
 
         else:
-            msg = self.main(context, **slots)
+            msg = self.call_main(context, **slots)
+            if inspect.isawaitable(msg):
+                return self._closing(msg)
+
             return ClosingMessage(msg)
 
+    async def _closing(self, msg):
+        return ClosingMessage(await msg)
+
     @abc.abstractmethod
     def main(self, context, **kwargs):
         raise NotImplementedError()
 
 
+class BackgroundPlugin:
+    """
+    Long running producer.
+
+    main() is an async generator; everything it yields is published on the
+    plugin's topic. The router runs CONCURRENCY workers per plugin and
+    restarts them with backoff (initial, maximum seconds) if they fail.
+    """
+    WEIGHT = 0
+    TOPIC = None
+    CONCURRENCY = 1
+    BACKOFF = (1, 60)
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(self.NAME)
+
+    @property
+    def NAME(self):
+        return self.__class__.__name__.split('.')[-1]
+
+    @property
+    def topic(self):
+        return self.TOPIC or self.NAME
+
+    def matches(self, text):
+        raise exc.MessageNotMatched(text)
+
+    @abc.abstractmethod
+    async def main(self, worker):
+        raise NotImplementedError()
+        yield
+
+
+class PushChannel:
+    """
+    Queue of messages pushed to a session outside of its request/response
+    cycle.
+
+    Most sessions never get one, so the queue and the task delivering it
+    are only created by the first push.
+    """
+    __slots__ = ('ui', 'loop', '_queue', '_task', '_closed')
+
+    def __init__(self, ui, loop):
+        self.ui = ui
+        self.loop = loop
+        self._queue = None
+        self._task = None
+        self._closed = False
+
+    def put_nowait(self, message):
+        if self._closed:
+            return
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._task = self.loop.create_task(self._deliver())
+
+        self._queue.put_nowait(message)
+
+    async def _deliver(self):
+        while True:
+            msg = await self._queue.get()
+            try:
+                await self.ui.push(msg)
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+
+
 class Context:
-    def __init__(self, plugin_name, ui, push_queue, loop=None):
+    __slots__ = ('plugin_name', 'plugin', 'ui', 'memory', 'loop',
+                 'push_queue', 'bus', 'tasks', 'timers')
+
+    def __init__(self, plugin_name, ui, push_queue, loop=None, bus=None,
+                 tasks=None, plugin=None, timers=None, memory=None):
         self.plugin_name = plugin_name
+        self.plugin = plugin
         self.ui = ui
-        self.memory = {}
-        self.loop = loop or asyncio.get_event_loop()
+        self.memory = {} if memory is None else memory
+        self.loop = loop or asyncio.get_running_loop()
         self.push_queue = push_queue
+        self.bus = bus
+        self.tasks = tasks
+        self.timers = timers
 
     def create_task(self, coro):
-        return self.loop.create_task(coro)
+        task = self.loop.create_task(coro)
+        if self.tasks is not None:
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        return task
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        return self.timers.call_at(when, callback, *args)
 
     def push_message(self, message):
         self.push_queue.put_nowait(message)
 
+    def subscribe(self, topic):
+        self.bus.subscribe(topic, self.push_queue)
+
+    def unsubscribe(self, topic):
+        self.bus.unsubscribe(topic, self.push_queue)
+
+    def publish(self, topic, message):
+        return self.bus.publish(topic, Broadcast(message, topic))
+
+
+def _module_mtime(module):
+    try:
+        return os.path.getmtime(module.__file__)
+    except (AttributeError, TypeError, OSError):
+        return None
+
 
 class Router:
-    def __init__(self, loop=None, plugins=None):
+    SHUTDOWN_TIMEOUT = 5
+
+    def __init__(self, loop=None, plugins=None, timeout=10,
+                 breaker_threshold=5, breaker_reset=30, max_inflight=100,
+                 session_rate=None, linger=False, match_budget=0.05,
+                 max_input=4096, sessions=None):
         plugins = plugins or []
+        # Shared conversation state (kv.SessionStore) for UIs with a
+        # session_id, None keeps it local
+        self.sessions = sessions
+        # UIs whose conversation state couldn't be shared, kept local until
+        # the conversation ends
+        self._unshared = set()
+        # Seconds all triggers may spend on a single message
+        self.match_budget = match_budget
+        self.max_input = max_input
+        self.match_overruns = 0
+        self._match_times = {}
+        # Keep running when the last user interface goes away
+        self.linger = linger
+        self.timeout = timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.logger = logging.getLogger('suzie.router')
+        self._breakers = {}
         self._ui_tasks = {}
-        self.registry = set(plugins)
-        self.loop = loop or asyncio.get_event_loop()
+        self._session_ids = itertools.count(1)
+        self._push_queues = {}
+        self._tasks = set()
+        self._supervisors = {}
+        self._mtimes = {}
+        self._index = []
+        self._closing = False
+        self._closed = asyncio.Event()
+        self.registry = set()
+        self.loop = loop or asyncio.get_running_loop()
+        self.bus = bus.EventBus()
+        self.timers = timers.TimerQueue(self.loop)
+        self.scheduler = scheduler.FairScheduler(max_inflight=max_inflight,
+                                                 loop=self.loop)
+        self.session_rate = session_rate
+        # owner (UI or shared connection) -> [TokenBucket, sessions]
+        self._session_buckets = {}
+        self.rate_limited = 0
+        self._plugin_buckets = {}
+
+        for plugin in plugins:
+            self.register(plugin)
 
     def load(self, plugin_cls):
         self.register(plugin_cls())
 
     def register(self, plugin):
         self.registry.add(plugin)
+        self._rebuild_index()
+
+        module = sys.modules.get(type(plugin).__module__)
+        if module is not None and module.__name__ not in self._mtimes:
+            self._mtimes[module.__name__] = _module_mtime(module)
+
+        if isinstance(plugin, BackgroundPlugin):
+            sv = supervisor.Supervisor(plugin, self.publish, loop=self.loop,
+                                       logger=plugin.logger)
+            self._supervisors[plugin] = sv
+            sv.start()
+
+    async def unregister(self, plugin):
+        self.registry.discard(plugin)
+        self._rebuild_index()
+
+        sv = self._supervisors.pop(plugin, None)
+        if sv is not None:
+            await sv.stop()
+
+    def _rebuild_index(self):
+        self._index = sorted(self.registry, key=lambda x: x.WEIGHT)
+
+    async def reload(self, force=False):
+        """
+        Re-import plugin modules changed on disk and replace their plugins
+        with fresh instances.
+
+        Conversations already in progress keep the instance they started
+        with, new ones are routed to the new instances. It is all or
+        nothing: if a module fails to import or a plugin to instantiate,
+        the error is logged, every module is put back as it was and the
+        running plugins are kept.
+        """
+        changed = {}
+        for (name, mtime) in self._mtimes.items():
+            module = sys.modules.get(name)
+            if module is None or name == __name__:
+                continue
 
-    def get_handlers(self, text):
-        plugins = sorted(self.registry, key=lambda x: x.WEIGHT)
+            current = _module_mtime(module)
+            if force or current != mtime:
+                changed[name] = (module, current)
 
-        for plugin in plugins:
+        # importlib.reload() runs the new code in the same namespace
+        saved = {}
+        try:
+            for (name, (module, _)) in changed.items():
+                saved[name] = dict(module.__dict__)
+                importlib.reload(module)
+
+            swaps = []
+            for plugin in self.registry:
+                name = type(plugin).__module__
+                if name not in changed:
+                    continue
+
+                plugin_cls = getattr(changed[name][0], type(plugin).__name__,
+                                     None)
+                new = plugin_cls() if plugin_cls is not None else None
+                swaps.append((plugin, new))
+
+        except Exception:
+            self.logger.exception("Reload failed, keeping the running code")
+            for (name, namespace) in saved.items():
+                module = changed[name][0]
+                module.__dict__.clear()
+                module.__dict__.update(namespace)
+            return []
+
+        for (name, (_, current)) in changed.items():
+            self._mtimes[name] = current
+
+        replaced = []
+        for (plugin, new) in swaps:
+            await self.unregister(plugin)
+            if new is not None:
+                self.register(new)
+            replaced.append(plugin.NAME)
+
+        return replaced
+
+    def publish(self, topic, message):
+        return self.bus.publish(topic, Broadcast(message, topic))
+
+    def get_handlers(self, text):
+        if self.max_input is not None and len(text) > self.max_input:
+            self.match_overruns += 1
+            return
+
+        started = time.perf_counter()
+
+        for plugin in self._index:
+            # A running search can't be interrupted, the budget is checked
+            # between plugins
+            elapsed = time.perf_counter() - started
+            if self.match_budget is not None and elapsed > self.match_budget:
+                self.match_overruns += 1
+                errmsg = "Trigger matching over budget ({:.3f}s) for {!r}"
+                self.logger.warning(errmsg.format(elapsed, text[:80]))
+                return
+
+            t0 = time.perf_counter()
             try:
                 init_params = plugin.matches(text)
             except exc.MessageNotMatched:
-                continue
+                init_params = None
+            finally:
+                spent = time.perf_counter() - t0
+                if spent > self._match_times.get(plugin.NAME, 0):
+                    self._match_times[plugin.NAME] = spent
 
-            yield plugin, init_params
+            if init_params is not None:
+                yield plugin, init_params
 
     def get_handler(self, text):
         try:
@@ -197,44 +519,265 @@ class Router:
             raise exc.MessageNotMatched(text)
 
     async def _handle_ui(self, ui):
-        async def _queue_handler():
-            while True:
-                msg = await push_queue.get()
-                await ui.send(msg)
+        # Tags this session's log records, and those of tasks it spawns
+        logs.session.set('{}#{}'.format(ui.user, next(self._session_ids)))
 
+        # A single coroutine frame per session: idle sessions wait here
+        push_queue = PushChannel(ui, self.loop)
+        self._push_queues[ui] = push_queue
         context = None
-        push_queue = asyncio.Queue()
-        push_task = self.loop.create_task(_queue_handler())
+        # Sessions multiplexed over a connection share its limits
+        owner = ui if ui.connection is None else ui.connection
+        bucket = self._session_bucket(owner)
 
-        while True:
+        try:
+            while True:
+                try:
+                    msg = await ui.recv()
+                except EOFError:
+                    break
+
+                if bucket is not None and not bucket.consume():
+                    self.rate_limited += 1
+                    await ui.send("[!] Too many messages, slow down")
+                    continue
+
+                async with self.scheduler.slot(owner):
+                    context, response = await self._handle_message(
+                        ui, push_queue, context, str(msg))
+
+                # Sending waits for the client to read: a slow one must not
+                # hold a slot meanwhile
+                await ui.send(response)
+                ui.set_context(context)
+
+        finally:
+            self._release_bucket(owner)
+            del(self._push_queues[ui])
+            self._unshared.discard(ui)
+            self.bus.unsubscribe_all(push_queue)
+            push_queue.close()
+            self.remove_ui(ui)
+
+    def _session_bucket(self, owner):
+        if self.session_rate is None:
+            return None
+
+        try:
+            entry = self._session_buckets[owner]
+        except KeyError:
+            bucket = scheduler.TokenBucket(*self.session_rate,
+                                           clock=self.loop.time)
+            entry = self._session_buckets[owner] = [bucket, 0]
+
+        entry[1] += 1
+        return entry[0]
+
+    def _release_bucket(self, owner):
+        entry = self._session_buckets.get(owner)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del(self._session_buckets[owner])
+
+    async def _handle_message(self, ui, push_queue, context, text):
+        shared = (self.sessions is not None and ui.session_id is not None and
+                  ui not in self._unshared)
+        if shared:
+            context = await self._load_context(ui, push_queue, context)
+        resumed = context is not None
+
+        if context is None:
             try:
-                msg = await ui.recv()
-            except EOFError:
-                break
+                plugin, init_params = self.get_handler(text)
+            except exc.MessageNotMatched:
+                return None, "[?] I don't how to handle that"
+
+            context = self._new_context(ui, push_queue, plugin)
+            plugin.setup(context, **init_params)
+
+        response = await self._run_plugin(context.plugin, context, text)
+
+        if isinstance(response, ClosingMessage):
+            context = None
+            self._unshared.discard(ui)
+
+        if shared and (resumed or context is not None):
+            await self._save_context(ui, context)
+
+        return context, response
+
+    def _new_context(self, ui, push_queue, plugin, memory=None):
+        return Context(plugin_name=plugin.NAME, ui=ui, push_queue=push_queue,
+                       loop=self.loop, bus=self.bus, tasks=self._tasks,
+                       plugin=plugin, timers=self.timers, memory=memory)
+
+    async def _load_context(self, ui, push_queue, context):
+        # Other nodes may have moved the conversation on, the local cache
+        # makes this cheap while they haven't
+        try:
+            state = await self.sessions.load(ui.session_id)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            errmsg = "Session store unavailable, using local state: {}"
+            self.logger.warning(errmsg.format(e))
+            return context
+
+        if state is None:
+            return None
+
+        memory = dict(state['memory'])
+        if context is not None and context.plugin_name == state['plugin']:
+            context.memory = memory
+            return context
+
+        for plugin in self._index:
+            if plugin.NAME == state['plugin']:
+                return self._new_context(ui, push_queue, plugin, memory)
 
-            text = str(msg)
+        return None
 
+    async def _save_context(self, ui, context):
+        try:
             if context is None:
-                try:
-                    plugin, init_params = self.get_handler(text)
-                except exc.MessageNotMatched:
-                    response = "[?] I don't how to handle that"
-                    await ui.send(response)
-                    continue
+                await self.sessions.discard(ui.session_id)
+            else:
+                await self.sessions.save(ui.session_id, {
+                    'plugin': context.plugin_name,
+                    'memory': context.memory})
+
+        except TypeError as e:
+            errmsg = "State of {plugin} can't be shared, keeping it local: {e}"
+            self.logger.warning(errmsg.format(plugin=context.plugin_name,
+                                              e=e))
+            # What the store holds is older than the local state now
+            self._unshared.add(ui)
+            try:
+                await self.sessions.discard(ui.session_id)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                pass
 
-                context = Context(plugin_name=plugin.NAME, ui=ui,
-                                  push_queue=push_queue)
-                plugin.setup(context, **init_params)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            errmsg = "Session store unavailable, using local state: {}"
+            self.logger.warning(errmsg.format(e))
 
-            response = plugin.handle(context, text)
-            if isinstance(response, ClosingMessage):
-                context = None
+    def breaker(self, plugin):
+        try:
+            return self._breakers[plugin.NAME]
+        except KeyError:
+            pass
 
-            await ui.send(response)
-            ui.set_context(context)
+        cb = breaker.CircuitBreaker(threshold=self.breaker_threshold,
+                                    reset_timeout=self.breaker_reset,
+                                    clock=self.loop.time)
+        self._breakers[plugin.NAME] = cb
+        return cb
 
-        push_task.cancel()
-        self.remove_ui(ui)
+    def _plugin_bucket(self, plugin):
+        if plugin.RATE_LIMIT is None:
+            return None
+
+        try:
+            return self._plugin_buckets[plugin.NAME]
+        except KeyError:
+            pass
+
+        bucket = scheduler.TokenBucket(*plugin.RATE_LIMIT,
+                                       clock=self.loop.time)
+        self._plugin_buckets[plugin.NAME] = bucket
+        return bucket
+
+    async def _run_plugin(self, plugin, context, text):
+        bucket = self._plugin_bucket(plugin)
+        if bucket is not None and not bucket.consume():
+            self.rate_limited += 1
+            return ClosingMessage(plugin.FALLBACK)
+
+        cb = self.breaker(plugin)
+        if not cb.allow():
+            return ClosingMessage(plugin.FALLBACK)
+
+        timeout = plugin.TIMEOUT
+        if timeout is None:
+            timeout = self.timeout
+
+        token = logs.plugin.set(plugin.NAME)
+        try:
+            return await self._call_plugin(plugin, cb, timeout, context, text)
+        finally:
+            logs.plugin.reset(token)
+
+    async def _call_plugin(self, plugin, cb, timeout, context, text):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s handles %r", plugin.NAME, text)
+
+        started = self.loop.time()
+
+        try:
+            response = plugin.handle(context, text)
+            if inspect.isawaitable(response):
+                # Synchronous code can't be interrupted, only what is left
+                # of the budget is given to the asynchronous part
+                remaining = timeout - (self.loop.time() - started)
+                response = await asyncio.wait_for(response, max(remaining, 0))
+
+        except asyncio.CancelledError:
+            cb.abandon()
+            raise
+
+        except asyncio.TimeoutError:
+            cb.failure()
+            errmsg = "{plugin} exceeded its {timeout}s deadline"
+            self.logger.warning(errmsg.format(plugin=plugin.NAME,
+                                              timeout=timeout))
+            return ClosingMessage(plugin.FALLBACK)
+
+        except Exception:
+            cb.failure()
+            errmsg = "{plugin} failed handling {text!r}"
+            self.logger.exception(errmsg.format(plugin=plugin.NAME, text=text))
+            return ClosingMessage(plugin.FALLBACK)
+
+        if self.loop.time() - started > timeout:
+            errmsg = "{plugin} blocked the loop beyond its {timeout}s deadline"
+            self.logger.warning(errmsg.format(plugin=plugin.NAME,
+                                              timeout=timeout))
+            cb.failure()
+        else:
+            cb.success()
+
+        return response
+
+    def stats(self):
+        plugins = {}
+        for plugin in self.registry:
+            info = {}
+            if plugin.NAME in self._breakers:
+                info['breaker'] = self._breakers[plugin.NAME].stats()
+            if getattr(plugin, 'cache', None) is not None:
+                info['cache'] = {'hits': plugin.cache.hits,
+                                 'misses': plugin.cache.misses,
+                                 'size': len(plugin.cache)}
+            if plugin.NAME in self._match_times:
+                info['match_time_max'] = self._match_times[plugin.NAME]
+            if plugin in self._supervisors:
+                sv = self._supervisors[plugin]
+                info['workers'] = sv.running
+                info['restarts'] = sv.restarts
+            plugins[plugin.NAME] = info
+
+        return {
+            'sessions': len(self._ui_tasks),
+            'tasks': len(self._tasks),
+            'timers': len(self.timers),
+            'inflight': self.scheduler.inflight,
+            'waiting': self.scheduler.waiting,
+            'rate_limited': self.rate_limited,
+            'match_overruns': self.match_overruns,
+            'logging': logs.stats(),
+            'sessions_store': (self.sessions.stats()
+                               if self.sessions is not None else {}),
+            'plugins': plugins,
+        }
 
     def add_ui(self, ui):
         task = self.loop.create_task(self._handle_ui(ui))
@@ -242,8 +785,58 @@ class Router:
 
     def remove_ui(self, ui):
         del(self._ui_tasks[ui])
-        if not self._ui_tasks:
-            self.loop.stop()
+        if not self._ui_tasks and not self._closing and not self.linger:
+            self.loop.create_task(self.shutdown())
+
+    async def _drain(self, deadline):
+        while True:
+            if self._tasks:
+                await asyncio.wait(set(self._tasks))
+                continue
+
+            when = self.timers.next_when()
+            if when is None or when > deadline:
+                break
+
+            await asyncio.sleep(max(when - self.loop.time(), 0))
+            # Let the timer callbacks run
+            await asyncio.sleep(0)
+
+        await asyncio.gather(*[
+            queue.join() for queue in self._push_queues.values()])
+
+    async def shutdown(self, timeout=None):
+        """
+        Wait up to timeout seconds for pending timers and push messages,
+        then cancel sessions and background plugins.
+        """
+        if self._closing:
+            return
+
+        self._closing = True
+        if timeout is None:
+            timeout = self.SHUTDOWN_TIMEOUT
+
+        try:
+            await asyncio.wait_for(
+                self._drain(self.loop.time() + timeout), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        self.timers.cancel_all()
+
+        tasks = list(self._ui_tasks.values()) + list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await asyncio.gather(*[
+            sv.stop() for sv in self._supervisors.values()])
+
+        self._closed.set()
+
+    async def wait_closed(self):
+        await self._closed.wait()
 
     def main(self):
-        self.loop.run_forever()
+        self.loop.run_until_complete(self.wait_closed())
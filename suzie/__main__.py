@@ -1,50 +1,277 @@
+import argparse
 import asyncio
-import asyncio.streams
+import ipaddress
+import json
+import logging
+import os
+import signal
 import sys
 
 
 import suzie
+import suzie.kv
+import suzie.logs
+import suzie.loops
 import suzie.plugins
+import suzie.profiler
+import suzie.record
+import suzie.triggers
 import suzie.ui
+import suzie.web
 
 
 class TCPServer:
-    def __init__(self, addr, port, router, loop=None):
+    """
+    Line based TCP server. A first line of 'MUX' switches the connection to
+    the multiplexed protocol; with `admin`, a first line of 'ADMIN' from a
+    loopback address opens an administration session:
+
+        stats                                  router statistics (JSON)
+        profile TARGET SECONDS [MODE] [FILE]   profile 'router' or a plugin
+
+    FILE is a plain file name inside `profile_dir`; without one reports
+    are only sent over the connection.
+    Every reply ends with a line holding a single '.'.
+    """
+    ADMIN_HANDSHAKE = 'ADMIN'
+
+    def __init__(self, addr, port, router, loop=None, wrap_ui=None,
+                 admin=False, profile_dir=None):
         self.addr = addr
         self.port = port
         self.router = router
-        self.loop = loop or asyncio.get_event_loop()
+        self.loop = loop or asyncio.get_running_loop()
+        self.wrap_ui = wrap_ui
+        self.admin = admin
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.server = None
 
     def start(self):
-        self.loop.create_task(asyncio.streams.start_server(
-            self._accept_client,
-            self.addr, self.port,
-            loop=self.loop))
+        self.loop.create_task(self.listen())
 
-    def _accept_client(self, reader, writer):
-        ui = suzie.ui.TCP(reader, writer)
+    async def listen(self):
+        self.server = await asyncio.start_server(
+            self._accept_client, self.addr, self.port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    def _add_ui(self, ui):
+        if self.wrap_ui:
+            ui = self.wrap_ui(ui)
         self.router.add_ui(ui)
 
+    async def _accept_client(self, reader, writer):
+        line = await reader.readline()
 
-def main(args=None):
-    if args is None:
-        args = sys.argv[:1]
+        if line.decode('utf-8').strip() == suzie.ui.Multiplexer.HANDSHAKE:
+            mux = suzie.ui.Multiplexer(reader, writer, self._add_ui)
+            await mux.run()
+            writer.close()
+            return
+
+        if (line.decode('utf-8').strip() == self.ADMIN_HANDSHAKE and
+                self.admin and self._is_local(writer)):
+            await self._serve_admin(reader, writer)
+            writer.close()
+            return
+
+        self._add_ui(suzie.ui.TCP(reader, writer, pending=line))
+
+    @staticmethod
+    def _is_local(writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            return ipaddress.ip_address(peer[0]).is_loopback
+        except (TypeError, ValueError):
+            return False
+
+    async def _serve_admin(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                cmd = line.decode('utf-8').split()
+                if not cmd:
+                    continue
+
+                try:
+                    reply = await self._admin_command(*cmd)
+                except (LookupError, TypeError, ValueError, OSError) as e:
+                    reply = 'ERR {!r}\n'.format(e)
+
+                writer.write(reply.encode('utf-8') + b'.\n')
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+    async def _admin_command(self, cmd, *args):
+        if cmd == 'stats':
+            return json.dumps(self.router.stats(), indent=2) + '\n'
+
+        if cmd == 'profile':
+            return await self._profile(*args)
+
+        raise ValueError(cmd)
+
+    def _profile_path(self, name):
+        if self.profile_dir is None:
+            raise ValueError('No profile directory configured')
+
+        root = os.path.realpath(self.profile_dir)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.dirname(path) != root or name.startswith('.'):
+            raise ValueError(name)
+
+        return path
+
+    async def _profile(self, target, seconds, mode='sampling', name=None):
+        path = None if name is None else self._profile_path(name)
 
-    loop = asyncio.get_event_loop()
+        if self.profiler is None:
+            self.profiler = suzie.profiler.Profiler(self.router)
 
+        report = await self.profiler.profile(target, float(seconds), mode)
+        if path is None:
+            return report
+
+        def write():
+            with open(path, 'w', encoding='utf-8') as fh:
+                fh.write(report)
+
+        await self.loop.run_in_executor(None, write)
+        return 'Written to {}\n'.format(path)
+
+
+def build_router(loop, background=True):
+    """
+    Router with every plugin; without `background`, those running on their
+    own (ForecastPoller) are left out
+    """
     r = suzie.Router(loop=loop)
     r.load(suzie.plugins.Alarm)
     r.load(suzie.plugins.Ping)
     r.load(suzie.plugins.Notes)
+    r.load(suzie.plugins.NoteSearch)
+    r.load(suzie.plugins.RecentNotes)
     r.load(suzie.plugins.Addition)
     r.load(suzie.plugins.Pizza)
     r.load(suzie.plugins.Downloader)
-    r.add_ui(suzie.ui.CommandLine())
+    r.load(suzie.plugins.Subscriptions)
+    r.load(suzie.plugins.Events)
+    r.load(suzie.plugins.Appointments)
+    r.load(suzie.plugins.Weather)
+    if background:
+        r.load(suzie.plugins.ForecastPoller)
+
+    return r
+
+
+async def serve(args):
+    loop = asyncio.get_running_loop()
+
+    wrap_ui = writer = None
+    if args.record:
+        writer = suzie.record.TraceWriter(args.record)
+
+        def wrap_ui(ui):
+            return suzie.record.Recording(ui, writer)
+
+    r = build_router(loop)
+    if args.sessions:
+        r.sessions = suzie.kv.SessionStore(
+            suzie.kv.parse_nodes(args.sessions), loop=loop)
+
+    if args.no_cli:
+        r.linger = True
+    else:
+        ui = suzie.ui.CommandLine()
+        r.add_ui(wrap_ui(ui) if wrap_ui else ui)
+
+    tcp_server = TCPServer(args.host, args.port, router=r, loop=loop,
+                           wrap_ui=wrap_ui, admin=args.admin,
+                           profile_dir=args.profile_dir)
+    await tcp_server.listen()
+
+    web_server = suzie.web.WebServer(args.host, args.web_port, router=r,
+                                     loop=loop, wrap_ui=wrap_ui)
+    await web_server.listen()
+
+    loop.add_signal_handler(signal.SIGHUP,
+                            lambda: loop.create_task(r.reload()))
+    loop.add_signal_handler(signal.SIGTERM,
+                            lambda: loop.create_task(r.shutdown()))
+
+    try:
+        await r.wait_closed()
+    finally:
+        tcp_server.close()
+        web_server.close()
+        if r.sessions is not None:
+            r.sessions.close()
+        if writer is not None:
+            await loop.run_in_executor(None, writer.close)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog='suzie')
+    parser.add_argument('--record', metavar='TRACE',
+                        help='Append conversation traces to TRACE')
+    parser.add_argument('--loop', default='auto',
+                        choices=['auto'] + sorted(suzie.loops.LOOPS),
+                        help='Event loop implementation')
+    parser.add_argument('--regex', default='re',
+                        choices=['re', 're2'],
+                        help='Trigger matching engine (re2 is linear-time, '
+                             'needs the re2 module)')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-file', metavar='PATH',
+                        help='Write logs to PATH instead of stderr')
+    parser.add_argument('--sessions', metavar='HOST:PORT[,...]',
+                        help='Share conversation state through these KV '
+                             'nodes (see python -m suzie.kv)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--web-port', type=int, default=5001)
+    parser.add_argument('--admin', action='store_true',
+                        help='Accept ADMIN sessions (stats, profiling) on '
+                             'the TCP port from loopback addresses')
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        help='Directory where admin sessions may write '
+                             'profile reports')
+    parser.add_argument('--no-cli', action='store_true',
+                        help='Run as a server, without the command line UI')
+    args = parser.parse_args(args)
+
+    try:
+        factory = suzie.loops.loop_factory(args.loop)
+        suzie.triggers.set_engine(args.regex)
+    except (ImportError, ValueError) as e:
+        parser.error(str(e))
 
-    tcp_server = TCPServer('127.0.0.1', 5000, router=r, loop=loop)
-    tcp_server.start()
+    handlers = None
+    if args.log_file:
+        handlers = [logging.FileHandler(args.log_file, encoding='utf-8')]
+    suzie.logs.install(level=getattr(logging, args.log_level),
+                       handlers=handlers)
 
-    loop.run_forever()
+    try:
+        with asyncio.Runner(loop_factory=factory) as runner:
+            try:
+                runner.run(serve(args))
+            except KeyboardInterrupt:
+                pass
+    finally:
+        suzie.logs.uninstall()
 
 
 if __name__ == '__main__':
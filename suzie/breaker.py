@@ -0,0 +1,73 @@
+import time
+
+
+class CircuitBreaker:
+    """
+    Fast-fails calls after `threshold` consecutive failures.
+
+    After `reset_timeout` seconds open, a single trial call is let through
+    (half-open); its outcome closes or re-opens the circuit.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+
+        if self.clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+
+        return self.OPEN
+
+    def allow(self):
+        state = self.state
+        if state == self.CLOSED:
+            return True
+
+        if state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def abandon(self):
+        """
+        A call allowed through ended without an outcome (it was
+        cancelled): if it was the trial, the next call gets to be one
+        """
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.total_failures += 1
+
+        if self._trial or self.failures >= self.threshold:
+            self._opened_at = self.clock()
+            self._trial = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'total_failures': self.total_failures,
+            'rejected': self.rejected,
+        }
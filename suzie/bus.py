@@ -0,0 +1,44 @@
+import collections
+
+
+class EventBus:
+    """
+    In-process topic based publish/subscribe.
+
+    Subscribers are queues (usually a session's push queue). The same
+    message object is handed to every subscriber of a topic, so it must be
+    built (and encoded) once by the publisher.
+    """
+    def __init__(self):
+        self._topics = collections.defaultdict(set)
+        self._subscriptions = collections.defaultdict(set)
+
+    def subscribe(self, topic, queue):
+        self._topics[topic].add(queue)
+        self._subscriptions[queue].add(topic)
+
+    def unsubscribe(self, topic, queue):
+        self._topics[topic].discard(queue)
+        if not self._topics[topic]:
+            del(self._topics[topic])
+
+        self._subscriptions[queue].discard(topic)
+        if not self._subscriptions[queue]:
+            del(self._subscriptions[queue])
+
+    def unsubscribe_all(self, queue):
+        for topic in list(self._subscriptions.get(queue, ())):
+            self.unsubscribe(topic, queue)
+
+    def topics(self, queue):
+        return set(self._subscriptions.get(queue, ()))
+
+    def subscribers(self, topic):
+        return len(self._topics.get(topic, ()))
+
+    def publish(self, topic, message):
+        queues = self._topics.get(topic, ())
+        for queue in queues:
+            queue.put_nowait(message)
+
+        return len(queues)
@@ -0,0 +1,105 @@
+import asyncio
+import collections
+import time
+
+
+_RETRY = object()
+
+
+class ResultCache:
+    """
+    Size bounded LRU cache with per entry TTL.
+
+    call_async() also deduplicates concurrent calls for the same key: only
+    the first caller runs the coroutine, the rest wait for its result. If
+    that caller is cancelled the next waiter runs it instead.
+    """
+    def __init__(self, ttl=None, maxsize=128, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            raise KeyError(key)
+
+        if expires is not None and expires <= self.clock():
+            del(self._data[key])
+            raise KeyError(key)
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def call(self, key, fn):
+        try:
+            value = self.get(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = fn()
+        self.set(key, value)
+        return value
+
+    async def call_async(self, key, coro_fn):
+        while True:
+            try:
+                value = self.get(key)
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                return value
+
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+
+            value = await asyncio.shield(fut)
+            if value is not _RETRY:
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await coro_fn()
+        except Exception as e:
+            fut.set_exception(e)
+            # Consume it in case nobody else is waiting
+            fut.exception()
+            raise
+        except BaseException:
+            # Only the leader was cancelled, one of the waiters takes over
+            fut.set_result(_RETRY)
+            raise
+        else:
+            self.set(key, value)
+            fut.set_result(value)
+            return value
+        finally:
+            del(self._inflight[key])
@@ -14,3 +14,9 @@ class SlotFilingError(Exception):
     """
     Raised if slot cannot be filled
     """
+
+
+class UnsafeTrigger(Exception):
+    """
+    Raised if a plugin trigger is prone to catastrophic backtracking
+    """
@@ -0,0 +1,391 @@
+"""
+Session state shared between nodes.
+
+Conversation state (the active plugin and its Context.memory) is kept in
+a key-value service partitioned with consistent hashing, so any node can
+pick up a session where another one left it. Each node reads through a
+local cache; the server tracks which connections hold a key and tells
+them to drop it when somebody else changes it.
+
+KVServer is an in-memory stand-in for the real service, speaking the
+same protocol: one JSON object per line,
+
+    {"id": 1, "op": "get", "key": "k"}          -> {"id": 1, "value": ...}
+    {"id": 2, "op": "set", "key": "k", "value": v} -> {"id": 2}
+    {"id": 3, "op": "del", "key": "k"}          -> {"id": 3}
+                                   server push  -> {"invalidate": "k"}
+
+    python -m suzie.kv --port 6400
+"""
+
+import argparse
+import asyncio
+import bisect
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import sys
+
+
+_TYPES = {'datetime': datetime.datetime, 'date': datetime.date,
+          'time': datetime.time}
+
+
+def _default(value):
+    for (name, cls) in _TYPES.items():
+        if isinstance(value, cls):
+            return {'$' + name: value.isoformat()}
+
+    if isinstance(value, datetime.timedelta):
+        return {'$timedelta': value.total_seconds()}
+
+    raise TypeError('{!r} is not serializable'.format(value))
+
+
+def _object_hook(obj):
+    if len(obj) == 1:
+        ((key, value),) = obj.items()
+        if key == '$timedelta':
+            return datetime.timedelta(seconds=value)
+        if key[:1] == '$' and key[1:] in _TYPES:
+            return _TYPES[key[1:]].fromisoformat(value)
+
+    return obj
+
+
+def dumps(value):
+    """
+    JSON with dates, times and timedeltas; raises TypeError for anything
+    else JSON can't hold
+    """
+    return json.dumps(value, default=_default, ensure_ascii=False)
+
+
+def loads(data):
+    return json.loads(data, object_hook=_object_hook)
+
+
+class HashRing:
+    """
+    Consistent hashing over node names, with `replicas` virtual points per
+    node so keys spread evenly and only ~1/N of them move when a node is
+    added or removed.
+    """
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        digest = hashlib.md5(value.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self._hash('{}#{}'.format(node, i))
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        self._points = [p for p in self._points if self._owners[p] != node]
+        self._owners = {p: self._owners[p] for p in self._points}
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError(key)
+
+        idx = bisect.bisect(self._points, self._hash(key))
+        return self._owners[self._points[idx % len(self._points)]]
+
+    @property
+    def nodes(self):
+        return set(self._owners.values())
+
+
+class KVServer:
+    def __init__(self, addr, port, loop=None):
+        self.addr = addr
+        self.port = port
+        self.loop = loop or asyncio.get_running_loop()
+        self.server = None
+        self.data = {}
+        self._clients = set()
+        # key -> writers of the connections caching it
+        self._holders = {}
+
+    async def listen(self):
+        self.server = await asyncio.start_server(
+            self._accept_client, self.addr, self.port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+        for task in self._clients:
+            task.cancel()
+
+    def _invalidate(self, key, writer):
+        for holder in self._holders.pop(key, ()):
+            if holder is not writer and not holder.is_closing():
+                holder.write(b'{"invalidate": ' +
+                             json.dumps(key).encode('utf-8') + b'}\n')
+
+        # Writers cache what they wrote
+        self._holders[key] = {writer}
+
+    def _handle(self, req, writer):
+        op, key = req['op'], req['key']
+
+        if op == 'get':
+            self._holders.setdefault(key, set()).add(writer)
+            return {'id': req['id'], 'value': self.data.get(key)}
+
+        if op == 'set':
+            self.data[key] = req['value']
+        elif op == 'del':
+            self.data.pop(key, None)
+        else:
+            return {'id': req['id'], 'error': 'unknown op'}
+
+        self._invalidate(key, writer)
+        return {'id': req['id']}
+
+    async def _accept_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients.add(task)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    resp = self._handle(json.loads(line), writer)
+                except (ValueError, KeyError, TypeError):
+                    break
+
+                writer.write(json.dumps(resp).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self._clients.discard(task)
+            for holders in self._holders.values():
+                holders.discard(writer)
+            writer.close()
+
+
+class KVClient:
+    """
+    Connection to one KV node with a local read-through cache.
+
+    Requests are pipelined over a single connection. Reads are served from
+    the cache until the server invalidates the key.
+    """
+    def __init__(self, host, port, loop=None, timeout=1):
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_running_loop()
+        self.timeout = timeout
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation, a response older than one can't be
+        # cached
+        self._epoch = 0
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+
+    async def _connect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+
+        if self._connecting is None:
+            self._connecting = self.loop.create_task(self._open())
+
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            self._connecting = None
+
+    async def _open(self):
+        reader, self._writer = await asyncio.open_connection(
+            self.host, self.port)
+        self._reader_task = self.loop.create_task(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                msg = json.loads(line)
+                if 'invalidate' in msg:
+                    self._epoch += 1
+                    self.cache.pop(msg['invalidate'], None)
+                    continue
+
+                fut = self._pending.pop(msg['id'], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+
+        except (ConnectionError, ValueError):
+            pass
+
+        finally:
+            # Without the connection invalidations can't be trusted
+            self._epoch += 1
+            self.cache.clear()
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = None
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionResetError())
+            self._pending = {}
+
+    async def _request(self, op, key, **kwargs):
+        await asyncio.wait_for(self._connect(), self.timeout)
+
+        req_id = next(self._ids)
+        # Encoding may fail, nothing is registered until it didn't
+        req = json.dumps(dict(kwargs, id=req_id, op=op, key=key))
+        fut = self.loop.create_future()
+        self._pending[req_id] = fut
+        self._writer.write(req.encode('utf-8') + b'\n')
+
+        try:
+            resp = await asyncio.wait_for(fut, self.timeout)
+        finally:
+            self._pending.pop(req_id, None)
+
+        if 'error' in resp:
+            raise ValueError(resp['error'])
+
+        return resp
+
+    def _store(self, key, value, epoch):
+        if epoch == self._epoch:
+            self.cache[key] = value
+
+    async def get(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        epoch = self._epoch
+        value = (await self._request('get', key))['value']
+        self._store(key, value, epoch)
+        return value
+
+    async def set(self, key, value):
+        self.cache.pop(key, None)
+        epoch = self._epoch
+        await self._request('set', key, value=value)
+        self._store(key, value, epoch)
+
+    async def delete(self, key):
+        self.cache.pop(key, None)
+        epoch = self._epoch
+        await self._request('del', key)
+        self._store(key, None, epoch)
+
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class SessionStore:
+    """
+    Conversation state partitioned over KV nodes ({name: (host, port)})
+    by session id, stored encoded with dumps().
+    """
+    PREFIX = 'session:'
+
+    def __init__(self, nodes, loop=None, replicas=100, timeout=1):
+        self.loop = loop or asyncio.get_running_loop()
+        self.ring = HashRing(nodes, replicas=replicas)
+        self.clients = {
+            name: KVClient(host, port, loop=self.loop, timeout=timeout)
+            for (name, (host, port)) in nodes.items()}
+        self.logger = logging.getLogger('suzie.kv')
+
+    def client_for(self, session_id):
+        return self.clients[self.ring.node_for(session_id)]
+
+    async def load(self, session_id):
+        data = await self.client_for(session_id).get(self.PREFIX + session_id)
+        return None if data is None else loads(data)
+
+    async def save(self, session_id, state):
+        """
+        Raises TypeError, before anything is sent, if `state` can't be
+        encoded
+        """
+        data = dumps(state)
+        await self.client_for(session_id).set(self.PREFIX + session_id, data)
+
+    async def discard(self, session_id):
+        await self.client_for(session_id).delete(self.PREFIX + session_id)
+
+    def stats(self):
+        return {name: {'hits': client.hits, 'misses': client.misses,
+                       'cached': len(client.cache)}
+                for (name, client) in self.clients.items()}
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+
+def parse_nodes(spec):
+    """
+    'host:port,host:port' -> {'host:port': (host, port), ...}
+    """
+    nodes = {}
+    for item in spec.split(','):
+        host, _, port = item.strip().rpartition(':')
+        nodes[item.strip()] = (host or '127.0.0.1', int(port))
+
+    return nodes
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='suzie.kv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6400)
+    args = parser.parse_args(args)
+
+    async def serve():
+        server = KVServer(args.host, args.port)
+        await server.listen()
+        await server.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""
+Logging off the event loop thread.
+
+install() routes every record through a bounded queue to a listener
+thread that owns the real handlers, so a slow stderr or disk never blocks
+the loop. If the queue is full records are dropped and counted instead of
+waiting for room.
+
+Records carry the `session` and `plugin` they were emitted for (from
+context variables set by the router) and DEBUG records are rate limited
+per logger, so debug logging on hot paths can stay enabled.
+"""
+
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+
+from . import scheduler
+
+
+FORMAT = ('%(asctime)s %(levelname)s %(name)s '
+          '[%(session)s/%(plugin)s] %(message)s')
+
+session = contextvars.ContextVar('session', default='-')
+plugin = contextvars.ContextVar('plugin', default='-')
+
+_listener = None
+_handler = None
+_previous = None
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.session = session.get()
+        record.plugin = plugin.get()
+        return True
+
+
+class DebugRateLimit(logging.Filter):
+    """
+    Lets at most `rate` DEBUG records per second (bursts of `burst`) and
+    logger through; records above DEBUG always pass.
+    """
+    def __init__(self, rate=100, burst=200, clock=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.suppressed = 0
+        self._buckets = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        try:
+            bucket = self._buckets[record.name]
+        except KeyError:
+            kwargs = {} if self.clock is None else {'clock': self.clock}
+            bucket = scheduler.TokenBucket(self.rate, self.burst, **kwargs)
+            self._buckets[record.name] = bucket
+
+        if bucket.consume():
+            return True
+
+        self.suppressed += 1
+        return False
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def install(level=logging.INFO, handlers=None, maxsize=10000,
+            debug_rate=(100, 200), fmt=FORMAT):
+    """
+    Replace the root logger handlers with the queue pipeline.
+
+    `handlers` (default: a stderr StreamHandler) run on the listener
+    thread. Returns the QueueHandler; its `dropped` attribute counts
+    records lost to a full queue.
+    """
+    global _listener, _handler, _previous
+
+    uninstall()
+
+    if handlers is None:
+        handlers = [logging.StreamHandler(sys.stderr)]
+    for h in handlers:
+        if h.formatter is None:
+            h.setFormatter(logging.Formatter(fmt))
+
+    _handler = QueueHandler(queue.Queue(maxsize))
+    _handler.addFilter(ContextFilter())
+    if debug_rate is not None:
+        _handler.addFilter(DebugRateLimit(*debug_rate))
+
+    root = logging.getLogger()
+    _previous = (list(root.handlers), root.level)
+    for h in _previous[0]:
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(
+        _handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    return _handler
+
+
+def uninstall():
+    """
+    Stop the listener thread once everything queued has been written and
+    put back the handlers install() replaced
+    """
+    global _listener, _handler, _previous
+
+    if _listener is None:
+        return
+
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    _listener.stop()
+
+    handlers, level = _previous
+    for h in handlers:
+        root.addHandler(h)
+    root.setLevel(level)
+
+    _listener = _handler = _previous = None
+
+
+def stats():
+    if _handler is None:
+        return {}
+
+    ret = {'queued': _handler.queue.qsize(), 'dropped': _handler.dropped}
+    for f in _handler.filters:
+        if isinstance(f, DebugRateLimit):
+            ret['suppressed'] = f.suppressed
+
+    return ret
@@ -0,0 +1,40 @@
+import asyncio
+import importlib
+
+
+def _uvloop_factory():
+    uvloop = importlib.import_module('uvloop')
+    return uvloop.new_event_loop
+
+
+LOOPS = {
+    'asyncio': lambda: asyncio.new_event_loop,
+    'uvloop': _uvloop_factory,
+}
+
+
+def available():
+    ret = []
+    for (name, factory) in LOOPS.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        ret.append(name)
+
+    return ret
+
+
+def loop_factory(name='auto'):
+    """
+    Returns a callable creating event loops of the given implementation.
+    'auto' picks uvloop when it is installed.
+    """
+    if name == 'auto':
+        name = 'uvloop' if 'uvloop' in available() else 'asyncio'
+
+    try:
+        return LOOPS[name]()
+    except KeyError as e:
+        errmsg = "Unknown event loop implementation '{name}'"
+        raise ValueError(errmsg.format(name=name)) from e
@@ -2,8 +2,10 @@ import suzie
 
 
 import asyncio
+import datetime
+import os
 import re
-from homelib import aemet
+from homelib import aemet, agenda, notes
 
 
 class Ping(suzie.Plugin):
@@ -21,6 +23,32 @@ class Ping(suzie.Plugin):
             return suzie.ClosingMessage(usertxt)
 
 
+class Subscriptions(suzie.Plugin):
+    TRIGGERS = [
+        r'^suscribe (?P<topic>\S+)$',
+        r'^desuscribe (?P<topic>\S+)$',
+        r'^suscripciones$'
+    ]
+
+    def handle(self, context, message):
+        # Triggers match regardless of case
+        command = message.lower()
+
+        if command.startswith('suscribe '):
+            topic = message.split(' ', 1)[1]
+            context.subscribe(topic)
+            return suzie.ClosingMessage('Subscribed to ' + topic)
+
+        elif command.startswith('desuscribe '):
+            topic = message.split(' ', 1)[1]
+            context.unsubscribe(topic)
+            return suzie.ClosingMessage('Unsubscribed from ' + topic)
+
+        else:
+            topics = sorted(context.bus.topics(context.push_queue))
+            return suzie.ClosingMessage(', '.join(topics) or 'None')
+
+
 class Alarm(suzie.SlottedPlugin):
     TRIGGERS = [
         '^beep in (?P<secs>\d+)$'
@@ -35,12 +63,8 @@ class Alarm(suzie.SlottedPlugin):
     def validate_slot(self, slot, text):
         return int(text)
 
-    async def _timer(self, ctx, secs):
-        await asyncio.sleep(secs)
-        ctx.push_message('Wakeup after ' + str(secs))
-
     def main(self, ctx, secs):
-        ctx.create_task(self._timer(ctx, secs))
+        ctx.call_later(secs, ctx.push_message, 'Wakeup after ' + str(secs))
         return 'OK. I will beep in {}'.format(secs)
 
 
@@ -99,7 +123,59 @@ class Pizza(suzie.SlottedPlugin):
                     size, when, ingredients))
 
 
-class Events(suzie.Plugin):
+# Reply of plugins keeping private data to users without an identity
+NO_IDENTITY = "[!] Only available to known users"
+
+
+class _PrivateSlottedPlugin(suzie.SlottedPlugin):
+    """
+    Keeps data of the user: refused, before asking for any slot, to users
+    without an identity
+    """
+    def handle(self, context, message):
+        if context.ui.identity is None:
+            return suzie.ClosingMessage(NO_IDENTITY)
+
+        return super().handle(context, message)
+
+AGENDA_PATH = os.environ.get(
+    'SUZIE_AGENDA', os.path.expanduser('~/.local/share/suzie/agenda.log'))
+REMIND_BEFORE = datetime.timedelta(minutes=15)
+
+# appointment -> (session, pending reminder)
+_reminders = {}
+
+
+def _remind(appt, ctx, text):
+    _reminders.pop(appt, None)
+    ctx.push_message(text)
+
+
+def _arm_reminders(ctx, appts, now):
+    """
+    Schedule reminders of appts to this session. Reminders only live in
+    memory: they are armed whenever the user talks to Events or
+    Appointments, after a restart included; those already armed for this
+    session are left alone.
+    """
+    for appt in appts:
+        delay = (appt.start - REMIND_BEFORE - now).total_seconds()
+        if delay <= 0:
+            continue
+
+        previous = _reminders.get(appt)
+        if previous is not None:
+            if previous[0] is ctx.ui and not previous[1].cancelled:
+                continue
+            previous[1].cancel()
+
+        reminder = 'Reminder: {about} at {start:%H:%M} in {where}'
+        reminder = reminder.format(**appt._asdict())
+        _reminders[appt] = (ctx.ui, ctx.call_later(delay, _remind, appt, ctx,
+                                                   reminder))
+
+
+class Events(_PrivateSlottedPlugin):
     TRIGGERS = [
         'añade cita'
     ]
@@ -108,14 +184,102 @@ class Events(suzie.Plugin):
         'where',
         'when'
     ]
+    DURATION = datetime.timedelta(hours=1)
+    REMIND_BEFORE = REMIND_BEFORE
+
+    def extract_slot(self, slot, text):
+        if slot != 'when':
+            return text
+
+        m = re.search(r'\b\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{2}\b', text)
+        if m:
+            return m.group(0)
+
+        m = re.search(r'\b(hoy|mañana) a las (\d{1,2})(:(\d{2}))?\b', text)
+        if m:
+            return m.group(0)
+
+    def validate_slot(self, slot, text):
+        if slot != 'when':
+            return text
+
+        m = re.search(r'^(hoy|mañana) a las (\d{1,2})(:(\d{2}))?$', text)
+        if not m:
+            return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M')
+
+        day = datetime.date.today()
+        if m.group(1) == 'mañana':
+            day += datetime.timedelta(days=1)
+
+        return datetime.datetime.combine(
+            day, datetime.time(int(m.group(2)), int(m.group(4) or 0)))
+
+    async def main(self, ctx, about, where, when):
+        ag = agenda.open_agenda(AGENDA_PATH)
+        try:
+            appt = await ag.add(ctx.ui.identity, when, when + self.DURATION,
+                                about, where)
+        except agenda.ConflictError as e:
+            msg = "You already have something then: {}"
+            return msg.format(', '.join(a.about for a in e.conflicts))
+
+        now = datetime.datetime.now()
+        try:
+            _arm_reminders(ctx, ag.upcoming(ctx.ui.identity, now, n=100),
+                           now)
+        except Exception:
+            # Don't keep what the user is told has failed
+            await ag.remove(appt.id)
+            raise
 
-    def main(self, ctx, about, where, when):
         msg = "OK. Your appointment: {when} at {where}. Subject: {about}"
         msg = msg.format(when=when, where=where, about=about)
+        return msg
+
+
+class Appointments(suzie.Plugin):
+    TRIGGERS = [
+        r'^próxima cita$',
+        r'^citas (hoy|mañana)$'
+    ]
+
+    def handle(self, context, message):
+        user = context.ui.identity
+        if user is None:
+            return suzie.ClosingMessage(NO_IDENTITY)
+
+        now = datetime.datetime.now()
+        ag = agenda.open_agenda(AGENDA_PATH)
+        _arm_reminders(context, ag.upcoming(user, now, n=100), now)
+
+        if message == 'próxima cita':
+            found = ag.upcoming(user, now)
+        else:
+            day = datetime.datetime.combine(now.date(), datetime.time())
+            if message.endswith('mañana'):
+                day += datetime.timedelta(days=1)
+            found = ag.between(user, day, day + datetime.timedelta(days=1))
+
+        if not found:
+            return suzie.ClosingMessage('Nothing')
+
+        msg = ' | '.join('{start:%Y-%m-%d %H:%M} {about} ({where})'.format(
+            **appt._asdict()) for appt in found)
         return suzie.ClosingMessage(msg)
 
 
-class Notes(suzie.SlottedPlugin):
+NOTES_PATH = os.environ.get(
+    'SUZIE_NOTES', os.path.expanduser('~/.local/share/suzie/notes.log'))
+
+
+def _format_notes(items):
+    if not items:
+        return 'No notes'
+
+    return ' | '.join('#{} {}'.format(n.id, n.text) for n in items)
+
+
+class Notes(_PrivateSlottedPlugin):
     TRIGGERS = [
         r'^anota (?P<item>.+)$',
         r'^anota$',
@@ -130,17 +294,56 @@ class Notes(suzie.SlottedPlugin):
     def extract_slot(self, slot, text):
         return text
 
-    def main(self, ctx, item):
+    async def main(self, ctx, item):
+        await notes.open_store(NOTES_PATH).add(ctx.ui.identity, item)
         msg = 'Got your note: {item}'.format(item=item)
         return msg
 
 
+class NoteSearch(_PrivateSlottedPlugin):
+    TRIGGERS = [
+        r'^busca nota (?P<query>.+)$',
+        r'^busca nota$',
+    ]
+    SLOTS = [
+        'query'
+    ]
+
+    def validate_slot(self, slot, text):
+        return text
+
+    def extract_slot(self, slot, text):
+        return text
+
+    def main(self, ctx, query):
+        found = notes.open_store(NOTES_PATH).search(ctx.ui.identity, query)
+        return _format_notes(found)
+
+
+class RecentNotes(suzie.Plugin):
+    TRIGGERS = [
+        r'^notas$',
+        r'^últimas (?P<n>\d+) notas$'
+    ]
+
+    def handle(self, context, message):
+        if context.ui.identity is None:
+            return suzie.ClosingMessage(NO_IDENTITY)
+
+        m = re.search(r'\d+', message)
+        n = int(m.group(0)) if m else 5
+
+        recent = notes.open_store(NOTES_PATH).recent(context.ui.identity, n)
+        return suzie.ClosingMessage(_format_notes(recent))
+
+
 class Addition(suzie.SlottedPlugin):
     TRIGGERS = [
         r'^(?P<x>\d+)\s*(and|\+)\s*(?P<y>\d+)$',
         r'^add$'
     ]
     SLOTS = ['x', 'y']
+    CACHE_TTL = 60 * 60
 
     def validate_slot(self, slot, value):
         try:
@@ -157,16 +360,19 @@ class Addition(suzie.SlottedPlugin):
         return msg
 
 
-class Weather(suzie.Plugin):
+class Weather(suzie.SlottedPlugin):
     NAME = 'weather'
     TRIGGERS = [
         r"^lloverá$",
         r"^lloverá (?P<when>.+)\??$"
     ]
     SLOTS = ['when']
+    CACHE_TTL = 10 * 60
+    WHEN = {
+        'hoy': aemet.When.TODAY,
+        'mañana': aemet.When.TOMORROW,
+    }
     MESSAGES = {
-        'INVALID_WHEN': 'Solo hoy o mañana',
-        'REQUEST_WHEN': 'Cuando, ¿hoy o mañana?',
         aemet.Probability.YES: 'Si',
         aemet.Probability.LIKELY: 'Posiblemente',
         aemet.Probability.MAYBE: 'Puede',
@@ -178,22 +384,61 @@ class Weather(suzie.Plugin):
         super().__init__(*args, **kwargs)
         self.aemet = aemet.Aemet()
 
-    def main(self, ctx, when):
-        when_table = {
-            'hoy': aemet.When.TODAY,
-            'mañana': aemet.When.TOMORROW,
-        }
-
-        res = self.aemet.info(when=when)
+    def extract_slot(self, slot, text):
+        return text.strip('¿? ')
 
+    def validate_slot(self, slot, text):
         try:
-            when = when_table[when]
-        except KeyError:
-            return suzie.ClosingMessage('Invalid when')
+            return self.WHEN[text]
+        except KeyError as e:
+            raise ValueError(text) from e
 
-        res = self.aemet.info(when=when)
-        msg = self.t(res)
-        return suzie.ClosingMessage(msg)
+    def cache_key(self, when):
+        # 'today' means something else tomorrow
+        return (when, datetime.date.today())
+
+    def _fetch(self, when):
+        self.aemet.clear()
+        return self.aemet.info(when=when)
+
+    async def main(self, ctx, when):
+        res = await ctx.loop.run_in_executor(None, self._fetch, when)
+        return self.MESSAGES[res]
+
+
+class ForecastPoller(suzie.BackgroundPlugin):
+    """
+    Polls AEMET and publishes rain forecast changes on the 'weather' topic
+    """
+    TOPIC = 'weather'
+    INTERVAL = 30 * 60
+    MESSAGES = {
+        aemet.Probability.YES: 'Va a llover hoy',
+        aemet.Probability.LIKELY: 'Probablemente llueva hoy',
+        aemet.Probability.MAYBE: 'Puede que llueva hoy',
+        aemet.Probability.UNLIKELY: 'No creo que llueva hoy',
+        aemet.Probability.NO: 'Hoy no llueve'
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.aemet = aemet.Aemet()
+
+    def _fetch(self):
+        self.aemet.clear()
+        return self.aemet.info(when=aemet.When.TODAY)
+
+    async def main(self, worker):
+        loop = asyncio.get_running_loop()
+        last = None
+
+        while True:
+            res = await loop.run_in_executor(None, self._fetch)
+            if res != last:
+                last = res
+                yield self.MESSAGES[res]
+
+            await asyncio.sleep(self.INTERVAL)
 
 
 # TRIGGERS = [
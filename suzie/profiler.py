@@ -0,0 +1,264 @@
+"""
+On demand profiling of a running router.
+
+Nothing is installed until a profile is requested, so there is no cost
+while it is off. A profile covers either the whole router (everything
+running on the event loop thread) or a single plugin's matches(),
+handle() and main(), for a given number of seconds:
+
+- 'deterministic' uses cProfile: exact call counts and times, with
+  noticeable overhead on what is being profiled. For a plugin it is only
+  enabled while the plugin's own code runs, coroutines included.
+- 'sampling' looks at the loop thread's stack every `interval` seconds
+  from another thread: approximate, but cheap enough for production.
+"""
+
+import asyncio
+import cProfile
+import collections
+import functools
+import inspect
+import io
+import pstats
+import sys
+import threading
+import time
+
+
+MODES = ('sampling', 'deterministic')
+PLUGIN_METHODS = ('matches', 'handle', 'main')
+
+
+class _Switch:
+    """
+    Re-entrant enable/disable of a profile: the plugin's handle() calling
+    its own main() must not switch it off halfway
+    """
+    def __init__(self, profile):
+        self.profile = profile
+        self.depth = 0
+
+    def __enter__(self):
+        if not self.depth:
+            self.profile.enable()
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            self.profile.disable()
+
+
+class _Profiled:
+    """
+    Awaitable running a coroutine with the profile enabled only while
+    the coroutine itself executes
+    """
+    def __init__(self, coro, switch):
+        self.coro = coro
+        self.switch = switch
+
+    def __await__(self):
+        value, error = None, None
+
+        while True:
+            with self.switch:
+                try:
+                    if error is not None:
+                        future = self.coro.throw(error)
+                    else:
+                        future = self.coro.send(value)
+                except StopIteration as e:
+                    return e.value
+
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def _profiled(fn, switch):
+    if inspect.iscoroutinefunction(fn):
+        # Still a coroutine function, callers (the result cache) tell sync
+        # from async by that
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            return await _Profiled(fn(*args, **kwargs), switch)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with switch:
+            ret = fn(*args, **kwargs)
+
+        if inspect.iscoroutine(ret):
+            return _Profiled(ret, switch)
+
+        return ret
+
+    return wrapper
+
+
+class Sampler:
+    """
+    Samples the stack of `thread_id` from a background thread.
+
+    With `codes` only samples going through one of those code objects are
+    kept, and with `owner` as well only if one of those frames runs on
+    `owner` (its `self`): subclasses and other instances share the code
+    objects of inherited methods.
+    """
+    def __init__(self, thread_id, interval=0.001, codes=None, owner=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.codes = codes
+        self.owner = owner
+        self.samples = 0
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='suzie-sampler')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            kept = self.codes is None
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code)
+                if not kept and code in self.codes:
+                    kept = (self.owner is None or
+                            frame.f_locals.get('self') is self.owner)
+                frame = frame.f_back
+
+            if not kept:
+                continue
+
+            self.samples += 1
+            self.own[stack[0]] += 1
+            for code in set(stack):
+                self.cumulative[code] += 1
+
+    def report(self, top=25):
+        def where(code):
+            return '{}:{}({})'.format(code.co_filename, code.co_firstlineno,
+                                      code.co_name)
+
+        lines = ['{} samples every {}s'.format(self.samples, self.interval),
+                 '', '   own  cumul  function']
+        for (code, n) in self.cumulative.most_common(top):
+            lines.append('{:6d} {:6d}  {}'.format(self.own[code], n,
+                                                  where(code)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    def __init__(self, router, interval=0.001, top=25):
+        self.router = router
+        self.interval = interval
+        self.top = top
+        self._lock = asyncio.Lock()
+
+    def _plugin(self, name):
+        for plugin in self.router.registry:
+            if plugin.NAME == name:
+                return plugin
+
+        raise LookupError(name)
+
+    async def profile(self, target, seconds, mode='sampling'):
+        """
+        Profile `target` ('router' or a plugin name) for `seconds` and
+        return the report as text.
+
+        Raises LookupError for unknown targets and ValueError for unknown
+        modes; only one profile runs at a time.
+        """
+        if mode not in MODES:
+            raise ValueError(mode)
+
+        plugin = None if target == 'router' else self._plugin(target)
+
+        async with self._lock:
+            if mode == 'sampling':
+                return await self._sample(plugin, seconds)
+
+            return await self._trace(plugin, seconds)
+
+    async def _sample(self, plugin, seconds):
+        codes = None
+        if plugin is not None:
+            codes = set()
+            for name in PLUGIN_METHODS:
+                code = getattr(getattr(type(plugin), name, None),
+                               '__code__', None)
+                if code is not None:
+                    codes.add(code)
+
+        sampler = Sampler(threading.get_ident(), interval=self.interval,
+                          codes=codes, owner=plugin)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await self.router.loop.run_in_executor(None, sampler.stop)
+
+        return sampler.report(self.top)
+
+    async def _trace(self, plugin, seconds):
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+
+        if plugin is None:
+            # Everything on the loop thread, the sleep itself included
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+
+        else:
+            # Instance attributes shadow the methods for the duration. The
+            # result cache is bypassed: cached calls don't run the code and
+            # nothing produced by the wrappers may outlive the profile
+            switch = _Switch(profile)
+            cache = getattr(plugin, 'cache', None)
+            for name in PLUGIN_METHODS:
+                fn = getattr(plugin, name, None)
+                if fn is not None:
+                    setattr(plugin, name, _profiled(fn, switch))
+            if cache is not None:
+                plugin.cache = None
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                for name in PLUGIN_METHODS:
+                    plugin.__dict__.pop(name, None)
+                if cache is not None:
+                    plugin.cache = cache
+
+        buf = io.StringIO()
+        buf.write('{:.3f}s profiled\n'.format(time.perf_counter() - started))
+        try:
+            stats = pstats.Stats(profile, stream=buf)
+        except TypeError:
+            buf.write('No calls\n')
+        else:
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+        return buf.getvalue()
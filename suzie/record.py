@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import collections
+import difflib
+import itertools
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from . import ui as suzie_ui
+
+
+INBOUND = '<'
+OUTBOUND = '>'
+PUSH = '!'
+EOF = '.'
+
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n'}
+_UNESCAPES = {v: k for (k, v) in _ESCAPES.items()}
+
+
+def _escape(text):
+    return re.sub(r'[\\\t\n]', lambda m: _ESCAPES[m.group(0)], text)
+
+
+def _unescape(text):
+    return re.sub(r'\\[\\tn]', lambda m: _UNESCAPES[m.group(0)], text)
+
+
+Event = collections.namedtuple('Event', ['ts', 'session', 'direction', 'text'])
+
+
+class TraceWriter:
+    """
+    Append-only trace of conversations.
+
+    One event per line: timestamp, session, direction and text separated by
+    tabs. Direction is one of '<' (user), '>' (reply), '!' (push) or '.'
+    (end of session).
+
+    write() only queues events; a thread of its own writes whatever is
+    queued at once, so the file never blocks the loop. If the queue is
+    full (`maxsize`) events are dropped and counted in `dropped` instead of
+    waiting for room. close() returns once everything queued is written.
+    """
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.fh = open(path, 'a', encoding='utf-8')
+        self.dropped = 0
+        self._sessions = itertools.count()
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='suzie-trace')
+        self._thread.start()
+
+    def new_session(self):
+        return '{:x}.{}'.format(int(time.time()), next(self._sessions))
+
+    def write(self, session, direction, text=''):
+        line = '{ts:.6f}\t{session}\t{direction}\t{text}\n'.format(
+            ts=time.time(), session=session, direction=direction,
+            text=_escape(str(text)))
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            lines = [self._queue.get()]
+            try:
+                while lines[-1] is not None:
+                    lines.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = lines[-1] is None
+            if stop:
+                lines.pop()
+
+            self.fh.write(''.join(lines))
+            self.fh.flush()
+            if stop:
+                return
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.fh.close()
+
+
+def read_trace(path):
+    sessions = collections.OrderedDict()
+
+    with open(path, encoding='utf-8') as fh:
+        for line in fh:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+
+            ts, session, direction, text = line.split('\t', 3)
+            ev = Event(float(ts), session, direction, _unescape(text))
+            sessions.setdefault(session, []).append(ev)
+
+    return sessions
+
+
+class Recording(suzie_ui.UserInterface):
+    def __init__(self, ui, writer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ui = ui
+        self.writer = writer
+        self.session = writer.new_session()
+
+    @property
+    def user(self):
+        return self.ui.user
+
+    @property
+    def identity(self):
+        return self.ui.identity
+
+    @property
+    def session_id(self):
+        return self.ui.session_id
+
+    @property
+    def connection(self):
+        return self.ui.connection
+
+    async def recv(self):
+        try:
+            msg = await self.ui.recv()
+        except EOFError:
+            self.writer.write(self.session, EOF)
+            raise
+
+        self.writer.write(self.session, INBOUND, msg)
+        return msg
+
+    async def send(self, message):
+        self.writer.write(self.session, OUTBOUND, message)
+        await self.ui.send(message)
+
+    async def push(self, message):
+        self.writer.write(self.session, PUSH, message)
+        await self.ui.push(message)
+
+    def set_context(self, context):
+        self.ui.set_context(context)
+
+
+class ReplayUI(suzie_ui.UserInterface):
+    """
+    Replays the user's side of a recorded session.
+
+    With `speed`, messages are sent at their recorded time relative to
+    `origin` (by default the session's first event), `origin` being loop
+    time `started` (by default the first recv()).
+    """
+    def __init__(self, events, speed=None, loop=None, *args, origin=None,
+                 started=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = loop or asyncio.get_running_loop()
+        self.speed = speed
+        self.events = events
+        self.inbound = [ev for ev in events if ev.direction == INBOUND]
+        self.replies = []
+        self.pushes = []
+        self.latencies = []
+        self.origin = events[0].ts if origin is None else origin
+        self._pending = None
+        self._idx = 0
+        self._t0 = started
+
+    async def _wait_until(self, ts):
+        if self.speed is None:
+            return
+
+        delay = (ts - self.origin) / self.speed
+        delay = delay - (self.loop.time() - self._t0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def recv(self):
+        if self._t0 is None:
+            self._t0 = self.loop.time()
+
+        if self._idx >= len(self.inbound):
+            await self._wait_until(self.events[-1].ts)
+            raise EOFError()
+
+        ev = self.inbound[self._idx]
+        self._idx += 1
+        await self._wait_until(ev.ts)
+        self._pending = self.loop.time()
+        return ev.text
+
+    async def send(self, message):
+        if self._pending is not None:
+            self.latencies.append(self.loop.time() - self._pending)
+            self._pending = None
+
+        self.replies.append(str(message))
+
+    async def push(self, message):
+        self.pushes.append(str(message))
+
+    def set_context(self, context):
+        pass
+
+
+def _recorded_latencies(events):
+    ret = []
+    pending = None
+
+    for ev in events:
+        if ev.direction == INBOUND:
+            pending = ev.ts
+        elif ev.direction == OUTBOUND and pending is not None:
+            ret.append(ev.ts - pending)
+            pending = None
+
+    return ret
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+class ReplayReport:
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, sessions, elapsed, recorded_elapsed, copies=1):
+        self.sessions = sessions
+        self.copies = copies
+        self.elapsed = elapsed
+        self.recorded_elapsed = recorded_elapsed
+        self.messages = sum(len(ui.inbound) for (_, ui) in sessions)
+        self.diffs = []
+
+        self.latencies = []
+        self.recorded_latencies = []
+        for (name, ui) in sessions:
+            self.latencies.extend(ui.latencies)
+            self.recorded_latencies.extend(_recorded_latencies(ui.events))
+
+            expected = [ev.text for ev in ui.events
+                        if ev.direction == OUTBOUND]
+            diff = list(difflib.unified_diff(
+                expected, ui.replies,
+                fromfile=name + ' (recorded)', tofile=name + ' (replay)',
+                lineterm=''))
+            if diff:
+                self.diffs.append((name, diff))
+
+    @property
+    def throughput(self):
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def recorded_throughput(self):
+        if not self.recorded_elapsed:
+            return 0.0
+
+        return self.messages / self.copies / self.recorded_elapsed
+
+    def latency(self, pct, recorded=False):
+        values = self.recorded_latencies if recorded else self.latencies
+        return _percentile(values, pct)
+
+    def format(self):
+        lines = [
+            'sessions: {}, messages: {}'.format(
+                len(self.sessions), self.messages),
+            'throughput: {:.1f} msg/s (recorded {:.1f} msg/s)'.format(
+                self.throughput, self.recorded_throughput),
+        ]
+
+        for pct in self.PERCENTILES:
+            replay = self.latency(pct) * 1000
+            recorded = self.latency(pct, recorded=True) * 1000
+            lines.append(
+                'latency p{}: {:.3f} ms (recorded {:.3f} ms, '
+                'delta {:+.3f} ms)'.format(
+                    pct, replay, recorded, replay - recorded))
+
+        lines.append('sessions with different output: {}'.format(
+            len(self.diffs)))
+        for (_, diff) in self.diffs:
+            lines.extend(diff)
+
+        return '\n'.join(lines)
+
+
+class Replayer:
+    def __init__(self, router, trace, speed=None, copies=1):
+        self.router = router
+        self.trace = trace
+        self.speed = speed
+        self.copies = copies
+
+    def run(self):
+        return self.router.loop.run_until_complete(self.replay())
+
+    async def replay(self):
+        # Sessions keep their recorded offsets from the start of the trace
+        origin = min((events[0].ts for events in self.trace.values()),
+                     default=None)
+        started = self.router.loop.time()
+
+        sessions = []
+        for (name, events) in self.trace.items():
+            if not any(ev.direction == INBOUND for ev in events):
+                continue
+
+            for copy in range(self.copies):
+                ui = ReplayUI(events, speed=self.speed, loop=self.router.loop,
+                              origin=origin, started=started)
+                if self.copies > 1:
+                    sessions.append(('{}#{}'.format(name, copy), ui))
+                else:
+                    sessions.append((name, ui))
+
+        if not sessions:
+            return ReplayReport(sessions, 0.0, 0.0)
+
+        recorded_elapsed = max(
+            events[-1].ts for events in self.trace.values()) - origin
+
+        t0 = time.perf_counter()
+        for (_, ui) in sessions:
+            self.router.add_ui(ui)
+        await self.router.wait_closed()
+        elapsed = time.perf_counter() - t0
+
+        return ReplayReport(sessions, elapsed, recorded_elapsed,
+                            copies=self.copies)
+
+
+def main(args=None):
+    from . import __main__ as suzie_main
+    from . import plugins as suzie_plugins
+
+    parser = argparse.ArgumentParser(prog='suzie.record')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='Replay at recorded speed times SPEED '
+                             '(default: as fast as possible)')
+    parser.add_argument('--copies', type=int, default=1,
+                        help='Run each recorded session COPIES times')
+    args = parser.parse_args(args)
+
+    trace = read_trace(args.trace)
+
+    async def replay(scratch):
+        # Whatever the replayed sessions store goes to scratch files, not
+        # to the real agenda and notes
+        saved = (suzie_plugins.AGENDA_PATH, suzie_plugins.NOTES_PATH)
+        suzie_plugins.AGENDA_PATH = os.path.join(scratch, 'agenda.log')
+        suzie_plugins.NOTES_PATH = os.path.join(scratch, 'notes.log')
+        try:
+            router = suzie_main.build_router(asyncio.get_running_loop(),
+                                             background=False)
+            return await Replayer(router, trace, speed=args.speed,
+                                  copies=args.copies).replay()
+        finally:
+            (suzie_plugins.AGENDA_PATH, suzie_plugins.NOTES_PATH) = saved
+
+    # The runner shuts the executor down, pending writes included, before
+    # the scratch directory goes away
+    with tempfile.TemporaryDirectory(prefix='suzie-replay-') as scratch:
+        with asyncio.Runner() as runner:
+            report = runner.run(replay(scratch))
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'clock', 'tokens', '_last')
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self._last = clock()
+
+    def consume(self, n=1):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        if self.tokens < n:
+            return False
+
+        self.tokens -= n
+        return True
+
+
+class FairScheduler:
+    """
+    Admits at most `max_inflight` concurrent handles, granting free slots
+    to waiting sessions in round-robin order.
+    """
+    def __init__(self, max_inflight=100, loop=None):
+        self.max_inflight = max_inflight
+        self.loop = loop or asyncio.get_running_loop()
+        self.inflight = 0
+        self._waiting = collections.OrderedDict()
+
+    @property
+    def waiting(self):
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def acquire(self, session):
+        if self.inflight < self.max_inflight and not self._waiting:
+            self.inflight += 1
+            # Give other sessions a chance even when there is no contention
+            try:
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                self.release()
+                raise
+            return
+
+        fut = self.loop.create_future()
+        self._waiting.setdefault(session, collections.deque()).append(fut)
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            else:
+                self._discard(session, fut)
+            raise
+
+    def _discard(self, session, fut):
+        waiters = self._waiting.get(session)
+        if waiters is None:
+            return
+
+        try:
+            waiters.remove(fut)
+        except ValueError:
+            pass
+
+        if not waiters:
+            del(self._waiting[session])
+
+    def release(self):
+        self.inflight -= 1
+        self._wakeup()
+
+    def _wakeup(self):
+        while self.inflight < self.max_inflight and self._waiting:
+            session, waiters = self._waiting.popitem(last=False)
+            fut = waiters.popleft()
+            if waiters:
+                # Back to the end of the ring
+                self._waiting[session] = waiters
+
+            if fut.done():
+                continue
+
+            fut.set_result(None)
+            self.inflight += 1
+
+    def slot(self, session):
+        return _Slot(self, session)
+
+
+class _Slot:
+    __slots__ = ('scheduler', 'session')
+
+    def __init__(self, scheduler, session):
+        self.scheduler = scheduler
+        self.session = session
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.session)
+
+    async def __aexit__(self, *exc_info):
+        self.scheduler.release()
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+
+class Supervisor:
+    """
+    Keeps the workers of a background plugin running.
+
+    Each worker iterates plugin.main() and publishes whatever it yields.
+    Failing workers are restarted with exponential backoff; a worker that
+    ran for longer than the maximum backoff is considered healthy and its
+    backoff is reset.
+    """
+    def __init__(self, plugin, publish, loop=None, logger=None):
+        self.plugin = plugin
+        self.publish = publish
+        self.loop = loop or asyncio.get_running_loop()
+        self.logger = logger or logging.getLogger('suzie.supervisor')
+        self.tasks = []
+        self.restarts = 0
+
+    @property
+    def running(self):
+        return sum(1 for task in self.tasks if not task.done())
+
+    def start(self):
+        if self.running:
+            return
+
+        self.tasks = [
+            self.loop.create_task(self._run(worker))
+            for worker in range(self.plugin.CONCURRENCY)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _run(self, worker):
+        initial, maximum = self.plugin.BACKOFF
+        delay = initial
+
+        while True:
+            started = self.loop.time()
+            try:
+                async for msg in self.plugin.main(worker):
+                    self.publish(self.plugin.topic, msg)
+
+                return
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                errmsg = "Worker {worker} of {plugin} failed"
+                errmsg = errmsg.format(worker=worker, plugin=self.plugin.NAME)
+                self.logger.exception(errmsg)
+
+            self.restarts += 1
+            if self.loop.time() - started > maximum:
+                delay = initial
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, maximum)
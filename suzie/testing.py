@@ -0,0 +1,181 @@
+"""
+Drive the router without sockets or wall clock time.
+
+VirtualTimeLoop is an event loop whose clock only moves when there is
+nothing ready to run: instead of sleeping until the next timer it jumps
+straight to it, so timers, deadlines and sleeps of any length complete
+immediately and in a deterministic order. MemoryUI is a user interface
+fed from a script and recording everything the router answers.
+
+    ui, = converse([suzie.plugins.Alarm()], ['beep in 3600', 3601])
+    ui.transcript == [('close', 'OK. I will beep in 3600'),
+                      ('push', 'Wakeup after 3600')]
+"""
+
+import asyncio
+import selectors
+
+from . import Router
+from . import ui as suzie_ui
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events:
+            return events
+
+        if timeout is None or (timeout > 0 and self._clock._executing):
+            # Nothing scheduled, or work running in an executor: only
+            # another thread (call_soon_threadsafe) can wake the loop up.
+            # Executor jobs take no virtual time
+            return super().select(None)
+
+        self._clock.advance(timeout)
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop with a virtual clock starting at `start`.
+
+    Real file descriptors are still polled, without blocking, so streams
+    and executors keep working; time only advances when the loop is idle
+    and nothing runs in an executor.
+    """
+    def __init__(self, start=0.0):
+        self._now = start
+        self._executing = 0
+        super().__init__(selector=_VirtualSelector(self))
+
+    def run_in_executor(self, executor, func, *args):
+        fut = super().run_in_executor(executor, func, *args)
+        self._executing += 1
+        fut.add_done_callback(self._executed)
+        return fut
+
+    def _executed(self, fut):
+        self._executing -= 1
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+
+
+class MemoryUI(suzie_ui.UserInterface):
+    """
+    In-memory user interface.
+
+    Lines are queued with say() (or given as `lines`); a number instead of
+    a line waits that many seconds before reading on. With `close` the
+    session ends once the script runs out, otherwise it waits for more.
+    Output is kept in `transcript` as (kind, text) pairs, kind being one
+    of message_kind()'s values.
+    """
+    def __init__(self, lines=(), user='test', close=True, session_id=None,
+                 identity=None):
+        self.user = user
+        self.session_id = session_id
+        self.identity = identity
+        self.inbox = asyncio.Queue()
+        self.transcript = []
+        self.context = None
+        self._output = None
+
+        self.say(*lines)
+        if close:
+            self.close()
+
+    def say(self, *lines):
+        for line in lines:
+            self.inbox.put_nowait(line)
+
+    def close(self):
+        self.inbox.put_nowait(None)
+
+    async def recv(self):
+        while True:
+            line = await self.inbox.get()
+            if line is None:
+                raise EOFError()
+
+            if isinstance(line, str):
+                return line
+
+            await asyncio.sleep(line)
+
+    def _record(self, message, push):
+        self.transcript.append((suzie_ui.message_kind(message, push=push),
+                                str(message)))
+        if self._output is not None and not self._output.done():
+            self._output.set_result(None)
+
+    async def send(self, message):
+        self._record(message, push=False)
+
+    async def push(self, message):
+        self._record(message, push=True)
+
+    def set_context(self, context):
+        self.context = context
+
+    async def wait_output(self, n=1):
+        """
+        Wait until the transcript has at least n entries
+        """
+        while len(self.transcript) < n:
+            self._output = asyncio.get_running_loop().create_future()
+            try:
+                await self._output
+            finally:
+                self._output = None
+
+    @property
+    def replies(self):
+        return [text for (kind, text) in self.transcript if kind != 'push']
+
+    @property
+    def pushes(self):
+        return [text for (kind, text) in self.transcript if kind == 'push']
+
+
+def converse(plugins, *scripts, loop=None, drain=24 * 60 * 60,
+             **router_kwargs):
+    """
+    Run every script as a concurrent session of a new router and return
+    their MemoryUIs once all have finished. A script may also be a
+    MemoryUI of its own, e.g. for a given user.
+
+    Timers still pending are given `drain` (virtual) seconds to fire before
+    the router shuts down. Runs on a new VirtualTimeLoop unless one is
+    given.
+    """
+    own_loop = loop is None
+    if own_loop:
+        loop = VirtualTimeLoop()
+
+    async def run():
+        router = Router(loop=loop, plugins=plugins, linger=True,
+                        **router_kwargs)
+        uis = [script if isinstance(script, MemoryUI) else MemoryUI(script)
+               for script in scripts]
+        for ui in uis:
+            router.add_ui(ui)
+
+        sessions = list(router._ui_tasks.values())
+        await asyncio.gather(*sessions)
+        await router.shutdown(timeout=drain)
+        return uis
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        if own_loop:
+            loop.close()
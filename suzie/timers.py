@@ -0,0 +1,104 @@
+import heapq
+import itertools
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'queue')
+
+    def __init__(self, when, callback, args, queue=None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        # Pending in this TimerQueue
+        self.queue = queue
+
+    def cancel(self):
+        if self.cancelled:
+            return
+
+        self.cancelled = True
+        if self.queue is not None:
+            queue, self.queue = self.queue, None
+            queue._cancelled(self)
+
+
+class TimerQueue:
+    """
+    Shared scheduler for many timers.
+
+    Timers live in a heap and only the earliest one has a handle in the
+    event loop, so pending timers cost a heap entry instead of a task.
+    Cancelled timers are dropped lazily when they reach the top, or all at
+    once when they are more than half of the heap.
+    """
+    # Heaps smaller than this are never rebuilt
+    COMPACT_MIN = 64
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._heap = []
+        self._seq = itertools.count()
+        self._handle = None
+        self._handle_when = None
+        self._live = 0
+
+    def __len__(self):
+        return self._live
+
+    def _cancelled(self, timer):
+        self._live -= 1
+        if (len(self._heap) >= self.COMPACT_MIN and
+                self._live < len(self._heap) // 2):
+            self._heap = [entry for entry in self._heap
+                          if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args, self)
+        heapq.heappush(self._heap, (when, next(self._seq), timer))
+        self._live += 1
+        if self._handle_when is None or when < self._handle_when:
+            self._arm()
+
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.loop.time() + delay, callback, *args)
+
+    def next_when(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        return self._heap[0][0] if self._heap else None
+
+    def cancel_all(self):
+        for (_, _, timer) in self._heap:
+            timer.queue = None
+            timer.cancel()
+        self._heap = []
+        self._live = 0
+        self._arm()
+
+    def _arm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = self._handle_when = None
+
+        when = self.next_when()
+        if when is not None:
+            self._handle = self.loop.call_at(when, self._run)
+            self._handle_when = when
+
+    def _run(self):
+        self._handle = self._handle_when = None
+        now = self.loop.time()
+
+        while self._heap and self._heap[0][0] <= now:
+            (_, _, timer) = heapq.heappop(self._heap)
+            if not timer.cancelled:
+                timer.queue = None
+                self._live -= 1
+                self.loop.call_soon(timer.callback, *timer.args)
+
+        self._arm()
@@ -0,0 +1,266 @@
+import importlib
+import logging
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+EXPONENTIAL = 'exponential'
+POLYNOMIAL = 'polynomial'
+
+# Bounded repeats above this are as bad as unbounded ones
+REPEAT_LIMIT = 100
+
+_UNIVERSE = frozenset(range(256))
+_CATEGORIES = {
+    name: frozenset(i for i in range(256) if re.match(pattern, chr(i)))
+    for (name, pattern) in [
+        ('CATEGORY_DIGIT', r'\d'),
+        ('CATEGORY_NOT_DIGIT', r'\D'),
+        ('CATEGORY_SPACE', r'\s'),
+        ('CATEGORY_NOT_SPACE', r'\S'),
+        ('CATEGORY_WORD', r'\w'),
+        ('CATEGORY_NOT_WORD', r'\W'),
+    ]
+}
+
+_engine = 're'
+_logger = logging.getLogger('suzie.triggers')
+
+
+def _charset(op, av):
+    """
+    Characters (first 256 code points) a single item can consume, or None
+    if the item doesn't consume characters by itself
+    """
+    op = str(op)
+
+    if op == 'LITERAL':
+        return frozenset([av]) if av < 256 else frozenset()
+
+    if op == 'NOT_LITERAL':
+        return _UNIVERSE - frozenset([av])
+
+    if op == 'ANY':
+        return _UNIVERSE - frozenset([10])
+
+    if op == 'IN':
+        chars = set()
+        negate = False
+        for (item, value) in av:
+            item = str(item)
+            if item == 'NEGATE':
+                negate = True
+            elif item == 'LITERAL':
+                chars.add(value)
+            elif item == 'RANGE':
+                chars.update(range(value[0], min(value[1], 255) + 1))
+            elif item == 'CATEGORY':
+                chars.update(_CATEGORIES.get(str(value), _UNIVERSE))
+        return _UNIVERSE - chars if negate else frozenset(chars)
+
+    return None
+
+
+def _is_repeat(op):
+    return str(op) in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+
+
+def _unbounded(op, av):
+    return str(op) in ('MAX_REPEAT', 'MIN_REPEAT') and av[1] > REPEAT_LIMIT
+
+
+def _repeated(op, av):
+    """
+    Whether the body of a bounded repeat can run more than once: an
+    ambiguous quantifier inside is retried at every iteration
+    """
+    return str(op) in ('MAX_REPEAT', 'MIN_REPEAT') and av[1] > 1
+
+
+def _children(op, av):
+    op = str(op)
+    if _is_repeat(op):
+        return [av[2]]
+    if op == 'SUBPATTERN':
+        return [av[-1]]
+    if op == 'BRANCH':
+        return av[1]
+    if op in ('ASSERT', 'ASSERT_NOT'):
+        return [av[1]]
+    if op == 'ATOMIC_GROUP':
+        return [av]
+    return []
+
+
+def _nullable(op, av):
+    op = str(op)
+    if _is_repeat(op):
+        return av[0] == 0 or _nullable_seq(av[2])
+    if op == 'SUBPATTERN':
+        return _nullable_seq(av[-1])
+    if op == 'BRANCH':
+        return any(_nullable_seq(seq) for seq in av[1])
+    return _charset(op, av) is None
+
+
+def _nullable_seq(seq):
+    return all(_nullable(op, av) for (op, av) in seq)
+
+
+def _first(seq):
+    ret = set()
+    for (op, av) in seq:
+        chars = _charset(op, av)
+        if chars is not None:
+            ret.update(chars)
+        elif str(op) not in ('ASSERT', 'ASSERT_NOT'):
+            for child in _children(op, av):
+                ret.update(_first(child))
+
+        if not _nullable(op, av):
+            break
+
+    return ret
+
+
+def _chars(seq):
+    ret = set()
+    for (op, av) in seq:
+        chars = _charset(op, av)
+        if chars is not None:
+            ret.update(chars)
+        for child in _children(op, av):
+            ret.update(_chars(child))
+
+    return ret
+
+
+def _branches(seq):
+    """
+    Alternatives of every alternation in `seq`, as written.
+
+    sre_parse factors a common prefix out of the alternatives ('(a|aa)'
+    becomes 'a(?:|a)'), leaving the BRANCH after it in the same sequence;
+    the prefix is put back so overlaps hidden by the factoring are seen.
+    """
+    for (idx, (op, av)) in enumerate(seq):
+        if str(op) == 'BRANCH':
+            yield [list(seq[:idx]) + list(alt) for alt in av[1]]
+        elif str(op) == 'SUBPATTERN':
+            yield from _branches(av[-1])
+
+
+def _walk(seq, problems, outer_first=None):
+    """
+    `outer_first` is set inside the body of a repeat running more than
+    once, to the characters its next iteration can start with
+    """
+    prev = None
+
+    for (idx, (op, av)) in enumerate(seq):
+        if _unbounded(op, av):
+            body = av[2]
+            chars = _chars(body)
+
+            if outer_first is not None:
+                # Characters that may come right after this quantifier:
+                # if they overlap, where it stops is ambiguous on every
+                # iteration of the outer one
+                rest = seq[idx + 1:]
+                follow = _first(rest)
+                if _nullable_seq(rest):
+                    follow |= outer_first
+                if chars & follow:
+                    problems.append((EXPONENTIAL, 'nested quantifiers'))
+
+            for branches in _branches(body):
+                # An alternative matching nothing goes on with the next
+                # iteration
+                firsts = [_first(branch) if not _nullable_seq(branch)
+                          else _first(branch) | _first(body)
+                          for branch in branches]
+                if any(a & b for (i, a) in enumerate(firsts)
+                       for b in firsts[i + 1:]):
+                    problems.append((EXPONENTIAL, 'overlapping alternatives '
+                                                  'under a quantifier'))
+
+            if prev is not None and prev & chars:
+                problems.append((POLYNOMIAL, 'adjacent overlapping '
+                                             'quantifiers'))
+
+            prev = chars
+            _walk(body, problems, outer_first=_first(body))
+            continue
+
+        if _repeated(op, av):
+            _walk(av[2], problems, outer_first=_first(av[2]))
+            if not _nullable(op, av):
+                prev = None
+            continue
+
+        if not _nullable(op, av):
+            prev = None
+
+        for child in _children(op, av):
+            _walk(child, problems, outer_first=outer_first)
+
+
+def analyze(pattern, flags=0):
+    """
+    Looks for constructs prone to catastrophic backtracking.
+
+    Returns a list of (severity, description) pairs; severity is
+    EXPONENTIAL (nested quantifiers, overlapping alternatives inside a
+    quantifier) or POLYNOMIAL (adjacent quantifiers over overlapping
+    characters). This is a heuristic: it can report false positives.
+    """
+    problems = []
+    _walk(list(sre_parse.parse(pattern, flags)), problems)
+
+    seen = set()
+    return [p for p in problems if not (p in seen or seen.add(p))]
+
+
+def engines():
+    ret = ['re']
+    try:
+        importlib.import_module('re2')
+    except ImportError:
+        pass
+    else:
+        ret.append('re2')
+
+    return ret
+
+
+def set_engine(name):
+    global _engine
+
+    if name not in ('re', 're2'):
+        raise ValueError(name)
+
+    if name == 're2':
+        importlib.import_module('re2')
+
+    _engine = name
+
+
+def compile(pattern, flags=0):
+    """
+    Compiles a trigger with the configured engine. With 're2' matching is
+    linear in the input; patterns re2 can't handle fall back to re.
+    """
+    if _engine == 're2':
+        re2 = importlib.import_module('re2')
+        inline = '(?i)' if flags & re.IGNORECASE else ''
+        try:
+            return re2.compile(inline + pattern)
+        except Exception:
+            errmsg = "Trigger {pattern!r} not supported by re2, using re"
+            _logger.warning(errmsg.format(pattern=pattern))
+
+    return re.compile(pattern, flags)
@@ -1,9 +1,37 @@
 import abc
 import asyncio
+import getpass
+import queue
 import re
+import threading
+
+import suzie
+
+
+def message_kind(message, push=False):
+    if push:
+        return 'push'
+    elif isinstance(message, suzie.ClosingMessage):
+        return 'close'
+    elif isinstance(message, suzie.RequestMessage):
+        return 'prompt'
+    else:
+        return 'reply'
 
 
 class UserInterface:
+    __slots__ = ()
+
+    user = 'anonymous'
+    # Stable id of the conversation across nodes, None if it can't move
+    session_id = None
+    # Authenticated name of the user, None if unknown. Unlike `user` (a
+    # peer address, 'anonymous') it can tell whose private data to use
+    identity = None
+    # Connection the session shares with others, rate limits and fair
+    # scheduling apply to it as a whole. None for the session itself
+    connection = None
+
     @abc.abstractmethod
     async def recv(self):
         raise NotImplementedError()
@@ -12,19 +40,32 @@ class UserInterface:
     async def send(self, message):
         raise NotImplementedError()
 
+    async def push(self, message):
+        await self.send(message)
+
     @abc.abstractmethod
     def set_context(self, context):
         raise NotImplementedError
 
 
 class TCP(UserInterface):
-    def __init__(self, reader, writer, *args, **kwargs):
+    __slots__ = ('reader', 'writer', 'pending', 'user')
+
+    def __init__(self, reader, writer, *args, pending=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.reader = reader
         self.writer = writer
+        # First line, if already read by the server
+        self.pending = pending
+
+        peer = writer.get_extra_info('peername')
+        self.user = str(peer[0]) if peer else UserInterface.user
 
     async def recv(self):
-        line = await self.reader.readline()
+        if self.pending is not None:
+            line, self.pending = self.pending, None
+        else:
+            line = await self.reader.readline()
         line = line.decode("utf-8")
 
         if not line:
@@ -35,21 +76,216 @@ class TCP(UserInterface):
         return line
 
     async def send(self, message):
-        self.writer.write((str(message) + "\n").encode('utf-8'))
+        # Broadcasts carry their payload already encoded
+        data = getattr(message, 'line', None)
+        if data is None:
+            data = (str(message) + "\n").encode('utf-8')
+
+        self.writer.write(data)
         await self.writer.drain()
 
     def set_context(self, ctx):
         pass
 
 
+class Multiplexer:
+    """
+    Several conversations over one TCP connection, enabled by sending
+    'MUX' as the first line. Each line is a frame:
+
+        client: REQ <id> <conversation> <text>
+                END <conversation>
+        server: REPLY|PROMPT|CLOSE <id> <text>
+                PUSH <conversation> <text>
+                END <conversation>
+                ERR <id> <text>
+                ERR <text>
+
+    Every conversation is a separate session in the router; replies carry
+    the id of the request they answer so clients can pipeline requests
+    and match out-of-order responses. The connection is rate limited and
+    scheduled as a single session, and may have at most MAX_CHANNELS
+    conversations with MAX_PENDING unanswered requests each: requests
+    over those limits get an ERR with their id. Frames that don't parse
+    get an ERR without one.
+    """
+    HANDSHAKE = 'MUX'
+    MAX_CHANNELS = 64
+    MAX_PENDING = 16
+    # Seconds conversations get to finish once the connection is closed
+    CLOSE_TIMEOUT = 5
+
+    def __init__(self, reader, writer, add_ui):
+        self.reader = reader
+        self.writer = writer
+        self.add_ui = add_ui
+        self.channels = {}
+        self._idle = None
+
+        peer = writer.get_extra_info('peername')
+        self.user = str(peer[0]) if peer else UserInterface.user
+
+    def write(self, *parts):
+        line = ' '.join(str(p) for p in parts)
+        self.writer.write((line + '\n').encode('utf-8'))
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    async def run(self):
+        self.write('MUX', 'OK')
+
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+
+                self.dispatch(line.decode('utf-8').strip())
+                await self.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            for channel in list(self.channels.values()):
+                channel.close()
+
+            # Their sessions may still be answering, the writer must outlive
+            # them
+            if self.channels:
+                self._idle = asyncio.get_running_loop().create_future()
+                try:
+                    await asyncio.wait_for(self._idle, self.CLOSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+
+    def dispatch(self, line):
+        parts = line.split(' ', 3)
+
+        if parts[0] == 'REQ' and len(parts) == 4:
+            (_, req_id, conv, text) = parts
+            channel = self.channels.get(conv)
+            if channel is None:
+                if len(self.channels) >= self.MAX_CHANNELS:
+                    self.write('ERR', req_id, 'Too many conversations')
+                    return
+
+                channel = MuxChannel(self, conv)
+                self.channels[conv] = channel
+                self.add_ui(channel)
+
+            if channel.inbox.qsize() >= self.MAX_PENDING:
+                self.write('ERR', req_id, 'Too many pending requests')
+                return
+
+            channel.feed(req_id, text)
+
+        elif parts[0] == 'END' and len(parts) == 2:
+            channel = self.channels.get(parts[1])
+            if channel is not None:
+                channel.close()
+
+        else:
+            self.write('ERR', 'Malformed frame')
+
+    def closed(self, channel):
+        if self.channels.get(channel.conversation) is channel:
+            del(self.channels[channel.conversation])
+            self.write('END', channel.conversation)
+
+        if not self.channels and self._idle is not None:
+            if not self._idle.done():
+                self._idle.set_result(None)
+
+
+class MuxChannel(UserInterface):
+    __slots__ = ('mux', 'conversation', 'user', 'inbox', 'request_id')
+
+    def __init__(self, mux, conversation, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mux = mux
+        self.conversation = conversation
+        self.user = mux.user
+        self.inbox = asyncio.Queue()
+        self.request_id = None
+
+    def feed(self, req_id, text):
+        self.inbox.put_nowait((req_id, text))
+
+    def close(self):
+        self.inbox.put_nowait(None)
+
+    async def recv(self):
+        item = await self.inbox.get()
+        if item is None:
+            self.mux.closed(self)
+            raise EOFError()
+
+        self.request_id, text = item
+        return text
+
+    async def send(self, message):
+        kind = message_kind(message).upper()
+        self.mux.write(kind, self.request_id, message)
+        await self.mux.drain()
+
+    @property
+    def connection(self):
+        return self.mux
+
+    async def push(self, message):
+        self.mux.write('PUSH', self.conversation, message)
+        await self.mux.drain()
+
+    def set_context(self, context):
+        pass
+
+
+def _resolve(fut, setter, value):
+    if not fut.done():
+        setter(value)
+
+
 class CommandLine(UserInterface):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.prompt = '> '
+        self.user = getpass.getuser()
+        # Whoever runs the process
+        self.identity = self.user
+        # Line requests for the stdin reader thread, started on first use
+        self._requests = None
+
+    def _read_lines(self, requests):
+        # A daemon thread rather than the loop's executor: input() can't be
+        # interrupted and shutting the executor down would wait for it
+        while True:
+            loop, fut, prompt = requests.get()
+            try:
+                result = (fut.set_result, input(prompt))
+            except Exception as e:
+                result = (fut.set_exception, e)
+
+            try:
+                loop.call_soon_threadsafe(_resolve, fut, *result)
+            except RuntimeError:
+                # Loop closed
+                return
 
     async def recv(self):
-        loop = asyncio.get_event_loop()
-        text = await loop.run_in_executor(None, input, self.prompt)
+        if self._requests is None:
+            self._requests = queue.Queue()
+            threading.Thread(target=self._read_lines, args=(self._requests,),
+                             daemon=True, name='suzie-stdin').start()
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._requests.put((loop, fut, self.prompt))
+        text = await fut
         text = re.sub(r'\s+', ' ', text.strip())
         if text in ['q', 'bye']:
             raise EOFError()
@@ -57,7 +293,7 @@ class CommandLine(UserInterface):
         return text
 
     async def send(self, message):
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         await loop.run_in_executor(None, print, message)
 
     def set_context(self, context):
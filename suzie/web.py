@@ -0,0 +1,498 @@
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import os
+import struct
+import urllib.parse
+
+from . import ui as suzie_ui
+
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONT = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+REASONS = {
+    101: 'Switching Protocols',
+    200: 'OK',
+    201: 'Created',
+    202: 'Accepted',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, *args):
+        super().__init__(status, *args)
+        self.status = status
+
+
+class ProtocolError(Exception):
+    """
+    WebSocket frame breaking RFC 6455; the connection is closed with `code`
+    """
+    def __init__(self, code, *args):
+        super().__init__(code, *args)
+        self.code = code
+
+
+def frame_for(message, push=False):
+    return {'type': suzie_ui.message_kind(message, push=push),
+            'text': str(message)}
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+        url = urllib.parse.urlsplit(target)
+        self.path = url.path
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+
+    @property
+    def keep_alive(self):
+        conn = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return conn == 'keep-alive'
+
+        return conn != 'close'
+
+
+async def read_request(reader, max_body=64 * 1024, max_headers=100,
+                       max_header_bytes=16 * 1024):
+    """
+    Raises HTTPError(400) for malformed requests and bodies over
+    `max_body`, and HTTPError(431) for more than `max_headers` header lines
+    or `max_header_bytes` bytes of them
+    """
+    line = await reader.readline()
+    if not line:
+        raise EOFError()
+
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError as e:
+        raise HTTPError(400) from e
+
+    headers = {}
+    count = size = 0
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError as e:
+            # Longer than the reader's buffer limit
+            raise HTTPError(431) from e
+        if not line:
+            raise EOFError()
+
+        count += 1
+        size += len(line)
+        if count > max_headers + 1 or size > max_header_bytes:
+            raise HTTPError(431)
+
+        line = line.decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    # int() would also take signs, spaces and underscores
+    length = headers.get('content-length', '0')
+    if not (length.isascii() and length.isdigit()):
+        raise HTTPError(400)
+
+    length = int(length)
+    if length > max_body:
+        raise HTTPError(400)
+
+    body = await reader.readexactly(length) if length else b''
+
+    return Request(method, target, version, headers, body)
+
+
+def write_response(writer, status, body=b'', headers=None, keep_alive=True):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+
+    lines = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, ''))]
+    headers = dict(headers or {})
+    if status != 101:
+        headers.setdefault('Content-Type', 'application/json')
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+    lines.extend('{}: {}'.format(k, v) for (k, v) in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def _mask(payload, key):
+    n = len(payload)
+    if not n:
+        return payload
+
+    key = (key * (n // 4 + 1))[:n]
+    value = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return value.to_bytes(n, 'big')
+
+
+def encode_frame(opcode, payload, mask=None):
+    head = bytes([0x80 | opcode])
+    maskbit = 0x80 if mask else 0
+    n = len(payload)
+
+    if n < 126:
+        head += bytes([maskbit | n])
+    elif n < 2 ** 16:
+        head += bytes([maskbit | 126]) + struct.pack('!H', n)
+    else:
+        head += bytes([maskbit | 127]) + struct.pack('!Q', n)
+
+    if mask:
+        return head + mask + _mask(payload, mask)
+
+    return head + payload
+
+
+async def read_frame(reader, max_size=64 * 1024, masked=False):
+    """
+    With `masked` (frames from a client) unmasked frames raise
+    ProtocolError
+    """
+    b0, b1 = await reader.readexactly(2)
+    fin = bool(b0 & 0x80)
+    opcode = b0 & 0x0F
+    n = b1 & 0x7F
+
+    if n == 126:
+        n, = struct.unpack('!H', await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack('!Q', await reader.readexactly(8))
+
+    if n > max_size:
+        raise EOFError()
+
+    if masked and not b1 & 0x80:
+        raise ProtocolError(CLOSE_PROTOCOL_ERROR, 'unmasked frame')
+
+    key = await reader.readexactly(4) if b1 & 0x80 else None
+    payload = await reader.readexactly(n)
+    if key:
+        payload = _mask(payload, key)
+
+    return fin, opcode, payload
+
+
+class WebSocket(suzie_ui.UserInterface):
+    __slots__ = ('reader', 'writer', 'closed')
+
+    # Bytes a message reassembled from fragments may take
+    MAX_MESSAGE = 64 * 1024
+
+    def __init__(self, reader, writer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    async def recv(self):
+        chunks = []
+        size = 0
+
+        while True:
+            try:
+                fin, opcode, payload = await read_frame(self.reader,
+                                                        masked=True)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                self.closed = True
+                raise EOFError() from e
+            except ProtocolError as e:
+                self._fail(e.code, e)
+
+            if opcode == OP_PING:
+                self.writer.write(encode_frame(OP_PONG, payload))
+                continue
+
+            if opcode == OP_PONG:
+                continue
+
+            if opcode == OP_CLOSE:
+                if not self.closed:
+                    self.writer.write(encode_frame(OP_CLOSE, payload[:2]))
+                    self.closed = True
+                self.writer.close()
+                raise EOFError()
+
+            chunks.append(payload)
+            size += len(payload)
+            if size > self.MAX_MESSAGE:
+                self._fail(CLOSE_TOO_BIG)
+
+            if fin:
+                break
+
+        try:
+            return b''.join(chunks).decode('utf-8')
+        except UnicodeDecodeError as e:
+            self._fail(CLOSE_INVALID_DATA, e)
+
+    def _fail(self, code, cause=None):
+        if not self.closed:
+            self.writer.write(encode_frame(OP_CLOSE, struct.pack('!H', code)))
+            self.closed = True
+        self.writer.close()
+        raise EOFError() from cause
+
+    async def _write(self, frame):
+        if self.closed:
+            return
+
+        data = json.dumps(frame).encode('utf-8')
+        self.writer.write(encode_frame(OP_TEXT, data))
+        await self.writer.drain()
+
+    async def send(self, message):
+        await self._write(frame_for(message))
+
+    async def push(self, message):
+        await self._write(frame_for(message, push=True))
+
+    def set_context(self, context):
+        pass
+
+
+class LongPoll(suzie_ui.UserInterface):
+    """
+    Session driven by plain HTTP requests: messages are POSTed and replies
+    and pushes are collected by (long) polling with GET.
+    """
+    __slots__ = ('session_id', 'loop', 'inbox', 'outbox', 'last_seen',
+                 '_waiter')
+
+    def __init__(self, session_id, loop=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_id = session_id
+        self.loop = loop or asyncio.get_running_loop()
+        self.inbox = asyncio.Queue()
+        self.outbox = []
+        self.last_seen = self.loop.time()
+        self._waiter = None
+
+    async def recv(self):
+        text = await self.inbox.get()
+        if text is None:
+            raise EOFError()
+
+        return text
+
+    def _append(self, frame):
+        self.outbox.append(frame)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def send(self, message):
+        self._append(frame_for(message))
+
+    async def push(self, message):
+        self._append(frame_for(message, push=True))
+
+    def set_context(self, context):
+        pass
+
+    def feed(self, text):
+        self.last_seen = self.loop.time()
+        self.inbox.put_nowait(text)
+
+    def close(self):
+        self.inbox.put_nowait(None)
+
+    async def poll(self, timeout):
+        self.last_seen = self.loop.time()
+
+        if not self.outbox and timeout > 0:
+            self._waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiter = None
+
+        frames, self.outbox = self.outbox, []
+        self.last_seen = self.loop.time()
+        return frames
+
+
+class WebServer:
+    """
+    HTTP/1.1 server exposing the router over WebSocket (GET /ws) and over
+    long polling:
+
+        POST   /sessions         create a session
+        POST   /sessions/<id>    send a message (body is the text)
+        GET    /sessions/<id>    wait up to ?timeout= seconds for output
+        DELETE /sessions/<id>    close the session
+    """
+    POLL_TIMEOUT = 25
+    SESSION_TIMEOUT = 120
+
+    def __init__(self, addr, port, router, loop=None, wrap_ui=None):
+        self.addr = addr
+        self.port = port
+        self.router = router
+        self.loop = loop or asyncio.get_running_loop()
+        self.wrap_ui = wrap_ui
+        self.sessions = {}
+        self.server = None
+        self._reaper = None
+        self._ids = itertools.count()
+
+    def start(self):
+        self.loop.create_task(self.listen())
+
+    async def listen(self):
+        self.server = await asyncio.start_server(
+            self._accept_client, self.addr, self.port)
+        self._reaper = self.loop.create_task(self._reap())
+
+    def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self.server is not None:
+            self.server.close()
+
+        for ui in self.sessions.values():
+            ui.close()
+        self.sessions = {}
+
+    def _add_ui(self, ui):
+        self.router.add_ui(self.wrap_ui(ui) if self.wrap_ui else ui)
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.SESSION_TIMEOUT / 4)
+
+            limit = self.loop.time() - self.SESSION_TIMEOUT
+            for (sid, ui) in list(self.sessions.items()):
+                if ui.last_seen < limit and ui._waiter is None:
+                    del(self.sessions[sid])
+                    ui.close()
+
+    async def _accept_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    req = await read_request(reader)
+                except (EOFError, asyncio.IncompleteReadError,
+                        ConnectionError):
+                    break
+                except HTTPError as e:
+                    write_response(writer, e.status, keep_alive=False)
+                    break
+
+                if req.path == '/ws':
+                    if self._upgrade(req, reader, writer):
+                        return
+                    break
+
+                try:
+                    status, body = await self._handle(req)
+                except HTTPError as e:
+                    status, body = e.status, {'error': REASONS[e.status]}
+
+                write_response(writer, status, body, keep_alive=req.keep_alive)
+                await writer.drain()
+
+                if not req.keep_alive:
+                    break
+
+        except ConnectionError:
+            pass
+
+        writer.close()
+
+    def _upgrade(self, req, reader, writer):
+        key = req.headers.get('sec-websocket-key')
+        if req.headers.get('upgrade', '').lower() != 'websocket' or not key:
+            write_response(writer, 400, keep_alive=False)
+            return False
+
+        accept = hashlib.sha1((key + WS_GUID).encode('ascii')).digest()
+        write_response(writer, 101, headers={
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': base64.b64encode(accept).decode('ascii'),
+        })
+        self._add_ui(WebSocket(reader, writer))
+        return True
+
+    def _new_session(self, sid):
+        ui = LongPoll(sid, loop=self.loop)
+        self.sessions[sid] = ui
+        self._add_ui(ui)
+        return ui
+
+    async def _handle(self, req):
+        parts = req.path.strip('/').split('/')
+        if parts[0] != 'sessions' or len(parts) > 2:
+            raise HTTPError(404)
+
+        if len(parts) == 1:
+            if req.method != 'POST':
+                raise HTTPError(405)
+
+            sid = '{}-{}'.format(next(self._ids), os.urandom(6).hex())
+            self._new_session(sid)
+            return 201, {'session': sid}
+
+        if req.method == 'POST':
+            try:
+                text = req.body.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise HTTPError(400) from e
+
+        try:
+            ui = self.sessions[parts[1]]
+        except KeyError as e:
+            # With shared state a session started on another node can go
+            # on here
+            if req.method != 'POST' or self.router.sessions is None:
+                raise HTTPError(404) from e
+            ui = self._new_session(parts[1])
+
+        if req.method == 'POST':
+            ui.feed(text)
+            return 202, {}
+
+        elif req.method == 'GET':
+            try:
+                timeout = float(req.query.get('timeout', self.POLL_TIMEOUT))
+            except ValueError as e:
+                raise HTTPError(400) from e
+
+            timeout = min(max(timeout, 0), self.POLL_TIMEOUT)
+            return 200, await ui.poll(timeout)
+
+        elif req.method == 'DELETE':
+            del(self.sessions[parts[1]])
+            ui.close()
+            return 200, {}
+
+        raise HTTPError(405)
@@ -1,35 +1,65 @@
-import unittest
+import asyncio
+import collections
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import logging
+import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
 
+import homelib.aemet
+import homelib.agenda
+import homelib.notes
 import suzie
+import suzie.breaker
+import suzie.cache
+import suzie.kv
+import suzie.logs
+import suzie.loops
 import suzie.plugins
-
-
-class SingleSlotPlugin(suzie.Plugin):
+import suzie.profiler
+import suzie.record
+import suzie.scheduler
+import suzie.testing
+import suzie.timers
+import suzie.triggers
+import suzie.ui
+import suzie.web
+from suzie import __main__ as suzie_main
+
+
+class SingleSlotPlugin(suzie.SlottedPlugin):
     TRIGGERS = [
-        r'test with x as (\S+)',  # For quick execution
-        r'test',                  # Generic trigger
+        r'test with x as (?P<x>\S+)',  # For quick execution
+        r'test',                       # Generic trigger
     ]
 
     SLOTS = [
         'x'
     ]
 
-    def extract(self, text):
-        ret = {}
-
-        m = re.search(r'\bset x as (\S+)\b', text)
-        if m:
-            ret['x'] = m.group(1)
+    def extract_slot(self, slot, text):
+        m = re.search(r'\bset {} as (\S+)\b'.format(slot), text)
+        return m.group(1) if m else text
 
-        return ret
+    def validate_slot(self, slot, value):
+        return value
 
-    def main(self, x):
+    def main(self, ctx, x):
         msg = "Got x={}".format(x)
         return msg
 
 
-class MultipleSlotPlugin(suzie.Plugin):
+class MultipleSlotPlugin(SingleSlotPlugin):
     TRIGGERS = [
         r'test with x as (?P<x>\S+)( and y as (?P<y>\S+))?',
         r'test with y as (?P<y>\S+)( and x as (?P<x>\S+))?',
@@ -41,191 +71,87 @@ class MultipleSlotPlugin(suzie.Plugin):
         'y'
     ]
 
-    def extract(self, text):
-        ret = {}
-
-        m = re.search(r'\bset x as (\S+)\b', text)
-        if m:
-            ret['x'] = m.group(1)
-
-        m = re.search(r'\bset y as (\S+)\b', text)
-        if m:
-            ret['y'] = m.group(1)
-
+    def setup(self, context, **params):
         # Strip Nones
-        ret = {k: v for (k, v) in ret.items() if v}
-        return ret
+        params = {k: v for (k, v) in params.items() if v}
+        super().setup(context, **params)
 
-    def main(self, x, y):
+    def main(self, ctx, x, y):
         msg = "Got x={!r}, y={!r}".format(x, y)
         return msg
 
 
-class EchoPlugin(suzie.Plugin):
+class EchoPlugin(suzie.SlottedPlugin):
     TRIGGERS = [
-        'echo (?P<what>)',
+        'echo (?P<what>.+)',
         'echo'
     ]
     SLOTS = [
         'what'
     ]
 
-    def extract(self, text):
-        if text:
-            return {'what': ''.join(reversed(text))}
-
-    def main(self, what):
-        return what
-
-
-class CommonAsserts:
-    def assertConversation(self, conv_or_plugin, log, final=True):
-        if isinstance(conv_or_plugin, suzie.Conversation):
-            c = conv_or_plugin
-        elif isinstance(conv_or_plugin, suzie.Plugin):
-            c = suzie.Conversation(conv_or_plugin)
-        else:
-            raise TypeError(conv_or_plugin)
-
-        is_multi_step = len(log) > 2 and final is True
-
-        for idx in list(range(0, len(log), 2)):
-            user = log[idx]
-            agent = log[idx+1]
-
-            reply = c.handle(user)
-            if is_multi_step and idx < len(log) - 2:
-                self.assertTrue(
-                    isinstance(reply, suzie.RequestMessage))
-
-            if agent:
-                self.assertEqual(str(reply), agent)
-
-        if final:
-            self.assertTrue(
-                isinstance(reply, suzie.ClosingMessage))
-        else:
-            self.assertTrue(
-                isinstance(reply, suzie.RequestMessage))
-
-
-class TestSlots(unittest.TestCase):
-    def test_constructor_with_args(self):
-        s = suzie.Slots(['x'], dict(x=1))
-        self.assertTrue(s.get('x'), 1)
-
-    def test_constructor_with_kwargs(self):
-        s = suzie.Slots(['x'], x=1)
-        self.assertTrue(s.get('x'), 1)
+    def extract_slot(self, slot, text):
+        return text
 
-    def test_constructor_with_args_and_kwargs(self):
-        s = suzie.Slots(['x', 'y', 'z'], dict(x=1, y=0), y=2, z=3)
-        self.assertEqual(s, dict(x=1, y=2, z=3))
+    def validate_slot(self, slot, value):
+        return value
 
-    def test_ready(self):
-        s = suzie.Slots(['x', 'y'], {'x': 1})
-        self.assertFalse(s.ready)
+    def main(self, ctx, what):
+        return ''.join(reversed(what))
 
-        s = suzie.Slots(['x', 'y'], x=1, y=2)
-        self.assertTrue(s.ready)
 
-
-class TestPlugin(unittest.TestCase):
-    def test_full_predicate(self):
-        plugin = MultipleSlotPlugin()
-        state = suzie.Slots.for_plugin(plugin)
-
-        plugin.handle('set x as foo and set y as bar', state)
-        self.assertEqual(state, dict(x='foo', y='bar'))
-
-    def test_partial_predicate(self):
-        plugin = MultipleSlotPlugin()
-        state = suzie.Slots.for_plugin(plugin)
-
-        plugin.handle('set x as foo', state)
-        self.assertEqual(state.get('x'), 'foo')
-        self.assertEqual(state.get('y'), suzie.Undefined)
-
-    def test_multistep_predicate(self):
-        plugin = MultipleSlotPlugin()
-        state = suzie.Slots.for_plugin(plugin)
-
-        plugin.handle('set x as foo', state)
-        self.assertEqual(state.get('x'), 'foo')
-        self.assertEqual(state.get('y'), suzie.Undefined)
-
-        plugin.handle('set y as bar', state)
-        self.assertEqual(state, {'x': 'foo', 'y': 'bar'})
-
-
-class TestConversation(unittest.TestCase, CommonAsserts):
-    def test_conv_with_initial_data(self):
-        conv = suzie.Conversation(SingleSlotPlugin(), slots_data=dict(x='1'))
-        self.assertTrue(conv.slots.get('x'), '1')
+class TestConversation(unittest.TestCase):
+    def assertConversation(self, plugin, log):
+        ui, = suzie.testing.converse([plugin], log[::2])
+        self.assertEqual(ui.transcript, log[1::2])
 
     def test_single_slot(self):
         self.assertConversation(
             SingleSlotPlugin(),
-            ['set x as 1', None]
+            ['test', ('prompt', 'Give x'),
+             'set x as 1', ('close', 'Got x=1')]
         )
 
     def test_multiple_slot(self):
         self.assertConversation(
             MultipleSlotPlugin(),
-            ['set x as 1', None,
-             'set y as 2', None]
+            ['test', ('prompt', 'Give x'),
+             'set x as 1', ('prompt', 'Give y'),
+             'set y as 2', ('close', "Got x='1', y='2'")]
         )
 
-
-class TestRouter(unittest.TestCase, CommonAsserts):
-    def test_no_initial_state(self):
-        router = suzie.Router(plugins=[MultipleSlotPlugin()])
-
-        resp = router.handle('test')
-        self.assertTrue(isinstance(resp, suzie.RequestMessage))
-
-        resp = router.handle('set x as 1')
-        self.assertTrue(isinstance(resp, suzie.RequestMessage))
-
-        resp = router.handle('set y as 2')
-        self.assertTrue(isinstance(resp, suzie.ClosingMessage))
-
     def test_quick_dialog(self):
-        router = suzie.Router(plugins=[MultipleSlotPlugin()])
+        self.assertConversation(
+            MultipleSlotPlugin(),
+            ['test with x as 1 and y as 2', ('close', "Got x='1', y='2'")]
+        )
 
-        resp = router.handle('test with x as 1 and y as 2')
-        self.assertTrue(isinstance(resp, suzie.ClosingMessage))
+    def test_partial_dialog(self):
+        self.assertConversation(
+            MultipleSlotPlugin(),
+            ['test with y as 2', ('prompt', 'Give x'),
+             'set x as 1', ('close', "Got x='1', y='2'")]
+        )
 
     def test_echo(self):
-        router = suzie.Router(plugins=[EchoPlugin()])
-
-        resp = router.handle('echo')
-        self.assertTrue(isinstance(resp, suzie.RequestMessage))
-
-        resp = router.handle('123')
-        self.assertTrue(isinstance(resp, suzie.ClosingMessage))
-        self.assertTrue(str(resp), '321')
+        self.assertConversation(
+            EchoPlugin(),
+            ['echo', ('prompt', 'Give what'),
+             '123', ('close', '321')]
+        )
 
     def test_echo_quick(self):
-        router = suzie.Router(plugins=[EchoPlugin()])
-
-        resp = router.handle('echo 321')
-        self.assertTrue(isinstance(resp, suzie.ClosingMessage))
-
-    # Partial dialog is not well supported
-    # def test_partial_dialog(self):
-    #     router = suzie.Router(plugins=[MultipleSlotPlugin()])
-
-    #     resp = router.handle('test with y as 2')
-    #     self.assertTrue(isinstance(resp, suzie.RequestMessage))
-
-    #     resp = router.handle('set x as 1')
-    #     self.assertTrue(isinstance(resp, suzie.ClosingMessage))
+        self.assertConversation(
+            EchoPlugin(),
+            ['echo 321', ('close', '123')]
+        )
 
 
-class TestDownloader(unittest.TestCase, CommonAsserts):
+class TestDownloader(unittest.TestCase):
     def setUp(self):
-        self.r = suzie.Router()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.r = suzie.Router(loop=loop)
         self.p = suzie.plugins.Downloader()
         self.r.register(self.p)
 
@@ -238,10 +164,1580 @@ class TestDownloader(unittest.TestCase, CommonAsserts):
         self.assertEqual(slots, {'url': 'foo'})
 
     def test_execution(self):
-        self.assertConversation(
-            suzie.plugins.Downloader(),
-            ['download http://foo.com/', None]
-        )
+        ui, = suzie.testing.converse([self.p], ['download http://foo.com/'])
+        self.assertEqual(ui.replies, ['Downloading http://foo.com/'])
+
+
+class TestRecord(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_trace_roundtrip(self):
+        writer = suzie.record.TraceWriter(self.path)
+        session = writer.new_session()
+        writer.write(session, suzie.record.INBOUND, 'a\tb\\n')
+        writer.write(session, suzie.record.OUTBOUND, 'multi\nline')
+        writer.close()
+
+        trace = suzie.record.read_trace(self.path)
+        self.assertEqual(
+            [ev.text for ev in trace[session]],
+            ['a\tb\\n', 'multi\nline'])
+
+    def test_trace_queue(self):
+        writer = suzie.record.TraceWriter(self.path, maxsize=2)
+        entered, release = threading.Event(), threading.Event()
+
+        class SlowFile:
+            def __init__(self, fh):
+                self.fh = fh
+
+            def write(self, data):
+                entered.set()
+                release.wait()
+                self.fh.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self.fh, name)
+
+        writer.fh = SlowFile(writer.fh)
+        session = writer.new_session()
+        writer.write(session, suzie.record.INBOUND, '0')
+        self.assertTrue(entered.wait(1))
+
+        # The writer thread is busy, these only queue or are dropped
+        for text in '123':
+            writer.write(session, suzie.record.INBOUND, text)
+        self.assertEqual(writer.dropped, 1)
+
+        release.set()
+        writer.close()
+        trace = suzie.record.read_trace(self.path)
+        self.assertEqual([ev.text for ev in trace[session]], ['0', '1', '2'])
+
+    def test_replay(self):
+        with open(self.path, 'w') as fh:
+            fh.write('1.0\ts\t<\tping\n'
+                     '1.1\ts\t>\tpong\n'
+                     '2.0\ts\t<\t1 + 1\n'
+                     '2.1\ts\t>\t1 + 1 = 3\n')
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop)
+        router.load(suzie.plugins.Ping)
+        router.load(suzie.plugins.Addition)
+
+        trace = suzie.record.read_trace(self.path)
+        report = suzie.record.Replayer(router, trace, copies=2).run()
+
+        self.assertEqual(report.messages, 4)
+        self.assertEqual(len(report.latencies), 4)
+        self.assertEqual(len(report.diffs), 2)
+        self.assertIn('+1 + 1 = 2', report.diffs[0][1])
+
+    def test_replay_offsets(self):
+        # The second session started 100s into the trace
+        with open(self.path, 'w') as fh:
+            fh.write('1000.0\ta\t<\tping\n'
+                     '1000.1\ta\t>\tpong\n'
+                     '1100.0\tb\t<\tping\n'
+                     '1100.1\tb\t>\tpong\n')
+
+        loop = suzie.testing.VirtualTimeLoop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()])
+
+        start = loop.time()
+        trace = suzie.record.read_trace(self.path)
+        report = suzie.record.Replayer(router, trace, speed=1).run()
+
+        self.assertEqual(report.diffs, [])
+        self.assertGreaterEqual(loop.time() - start, 100)
+        self.assertAlmostEqual(report.recorded_elapsed, 100.1)
+
+    def test_main(self):
+        with open(self.path, 'w') as fh:
+            fh.write('1.0\ts\t<\tping\n'
+                     '1.1\ts\t>\tpong\n')
+
+        paths = (suzie.plugins.AGENDA_PATH, suzie.plugins.NOTES_PATH)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            suzie.record.main([self.path])
+
+        self.assertIn('sessions with different output: 0', out.getvalue())
+        self.assertEqual(
+            (suzie.plugins.AGENDA_PATH, suzie.plugins.NOTES_PATH), paths)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie_main.build_router(loop, background=False)
+        self.assertFalse(any(isinstance(p, suzie.BackgroundPlugin)
+                             for p in router.registry))
+
+
+class TestEventBus(unittest.TestCase):
+    def test_subscriptions_ignore_case(self):
+        ui, = suzie.testing.converse([suzie.plugins.Subscriptions()], [
+            'Suscribe news', 'SUSCRIPCIONES', 'Desuscribe news',
+            'suscripciones'])
+        self.assertEqual(ui.replies, ['Subscribed to news', 'news',
+                                      'Unsubscribed from news', 'None'])
+
+    def test_fanout_shares_payload(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop)
+
+        queues = [asyncio.Queue() for _ in range(3)]
+        for q in queues[:2]:
+            ctx = suzie.Context('test', ui=None, push_queue=q, loop=loop,
+                                bus=router.bus)
+            ctx.subscribe('weather')
+
+        self.assertEqual(router.publish('weather', 'rain'), 2)
+        a, b = [q.get_nowait() for q in queues[:2]]
+        self.assertIs(a, b)
+        self.assertEqual(a.line, b'rain\n')
+        self.assertTrue(queues[2].empty())
+
+    def test_unsubscribe_all(self):
+        bus = suzie.bus.EventBus()
+        q = object()
+        bus.subscribe('a', q)
+        bus.subscribe('b', q)
+        bus.unsubscribe_all(q)
+        self.assertEqual(bus.topics(q), set())
+        self.assertEqual(bus.publish('a', 'x'), 0)
+
+
+class FlakyProducer(suzie.BackgroundPlugin):
+    BACKOFF = (0.001, 0.01)
+    CONCURRENCY = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runs = 0
+
+    async def main(self, worker):
+        self.runs += 1
+        yield 'run {}'.format(self.runs)
+        raise ValueError()
+
+
+class TestBackgroundPlugins(unittest.TestCase):
+    def test_supervised_restart_and_shutdown(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        producer = FlakyProducer(logger=logging.getLogger('null'))
+        producer.logger.disabled = True
+        router = suzie.Router(loop=loop, plugins=[producer])
+        queue = asyncio.Queue()
+        router.bus.subscribe(producer.topic, queue)
+
+        async def scenario():
+            while queue.qsize() < 6:
+                await asyncio.sleep(0.001)
+            await router.shutdown()
+
+        loop.run_until_complete(scenario())
+
+        sv = router._supervisors[producer]
+        self.assertGreaterEqual(sv.restarts, 4)
+        self.assertEqual(sv.running, 0)
+
+
+class ScriptedUI(suzie.ui.UserInterface):
+    def __init__(self, lines, hold=True):
+        self.lines = asyncio.Queue()
+        self.hold = hold
+        self.received = []
+
+        for line in lines:
+            self.lines.put_nowait(line)
+
+    async def recv(self):
+        if self.lines.empty() and not self.hold:
+            raise EOFError()
+
+        return await self.lines.get()
+
+    async def send(self, message):
+        self.received.append(str(message))
+
+    def set_context(self, context):
+        pass
+
+
+PLUGIN_MODULE = """
+import suzie
+
+
+class Version(suzie.SlottedPlugin):
+    TRIGGERS = [r'^version$']
+    SLOTS = ['confirm']
+
+    def extract_slot(self, slot, text):
+        return text
+
+    def validate_slot(self, slot, text):
+        return text
+
+    def main(self, ctx, confirm):
+        return '{}'
+"""
+
+
+class TestReloadAndShutdown(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_reload_keeps_inflight_conversations(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sys.path.insert(0, tmpdir)
+        self.addCleanup(sys.path.remove, tmpdir)
+        self.addCleanup(sys.modules.pop, 'reloadable_plugin', None)
+
+        path = os.path.join(tmpdir, 'reloadable_plugin.py')
+        with open(path, 'w') as fh:
+            fh.write(PLUGIN_MODULE.format('v1'))
+        module = importlib.import_module('reloadable_plugin')
+
+        router = suzie.Router(loop=self.loop)
+        router.load(module.Version)
+        ui = ScriptedUI(['version'])
+        new_ui = ScriptedUI(['version', 'yes'])
+        reloaded = []
+
+        async def scenario():
+            router.add_ui(ui)
+            while not ui.received:
+                await asyncio.sleep(0)
+
+            with open(path, 'w') as fh:
+                fh.write(PLUGIN_MODULE.format('v2'))
+            os.utime(path, (0, 0))
+            reloaded.extend(await router.reload())
+
+            ui.lines.put_nowait('yes')
+            router.add_ui(new_ui)
+            await asyncio.sleep(0.01)
+            await router.shutdown()
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual(reloaded, ['Version'])
+        self.assertEqual(ui.received[-1], 'v1')
+        self.assertEqual(new_ui.received[-1], 'v2')
+
+    def test_failed_reload_rolls_back(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sys.path.insert(0, tmpdir)
+        self.addCleanup(sys.path.remove, tmpdir)
+
+        modules = []
+        for name in ['rollback_a', 'rollback_b']:
+            self.addCleanup(sys.modules.pop, name, None)
+            with open(os.path.join(tmpdir, name + '.py'), 'w') as fh:
+                fh.write(PLUGIN_MODULE.format('v1'))
+            modules.append(importlib.import_module(name))
+
+        router = suzie.Router(loop=self.loop)
+        router.logger.disabled = True
+        self.addCleanup(setattr, router.logger, 'disabled', False)
+        for module in modules:
+            router.register(module.Version())
+        before = set(router.registry)
+
+        # One module is fine, the other one can't be instantiated
+        for (module, source) in zip(modules, [
+                PLUGIN_MODULE.format('v2'),
+                PLUGIN_MODULE.format('v2').replace("[r'^version$']", '[]')]):
+            with open(module.__file__, 'w') as fh:
+                fh.write(source)
+            os.utime(module.__file__, (0, 0))
+
+        replaced = self.loop.run_until_complete(router.reload())
+
+        self.assertEqual(replaced, [])
+        self.assertEqual(router.registry, before)
+        for module in modules:
+            self.assertIs(type(next(p for p in before
+                                    if type(p).__module__ ==
+                                    module.__name__)), module.Version)
+            self.assertNotEqual(router._mtimes[module.__name__], 0)
+
+    def test_shutdown_drains_timers_and_pushes(self):
+        router = suzie.Router(loop=self.loop)
+        router.load(suzie.plugins.Alarm)
+        ui = ScriptedUI(['beep in 0'])
+
+        async def scenario():
+            router.add_ui(ui)
+            await asyncio.sleep(0)
+            await router.shutdown(timeout=1)
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual(ui.received[-1], 'Wakeup after 0')
+
+
+class TestWeb(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_frame_roundtrip(self):
+        payload = 'ñ'.encode('utf-8') * 200
+        data = suzie.web.encode_frame(suzie.web.OP_TEXT, payload,
+                                      mask=b'abcd')
+
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        frame = self.loop.run_until_complete(suzie.web.read_frame(reader))
+        self.assertEqual(frame, (True, suzie.web.OP_TEXT, payload))
+
+    def test_malformed_input(self):
+        for length in [b'-1', b'abc', b'1_0', b' +1']:
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(b'POST /sessions HTTP/1.1\r\nContent-Length: ' +
+                             length + b'\r\n\r\n')
+            with self.assertRaises(suzie.web.HTTPError) as cm:
+                self.loop.run_until_complete(suzie.web.read_request(reader))
+            self.assertEqual(cm.exception.status, 400)
+
+        for headers in [b'X-A: 1\r\n' * 101, b'X-A: ' + b'a' * 17000 + b'\r\n',
+                        b'X-A: ' + b'a' * 70000 + b'\r\n']:
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(b'GET / HTTP/1.1\r\n' + headers + b'\r\n')
+            with self.assertRaises(suzie.web.HTTPError) as cm:
+                self.loop.run_until_complete(suzie.web.read_request(reader))
+            self.assertEqual(cm.exception.status, 431)
+
+        router = suzie.Router(loop=self.loop)
+        server = suzie.web.WebServer('127.0.0.1', 0, router=router,
+                                     loop=self.loop)
+        server.sessions['s1'] = suzie.web.LongPoll('s1', loop=self.loop)
+        req = suzie.web.Request('POST', '/sessions/s1', 'HTTP/1.1', {},
+                                b'\xff')
+        with self.assertRaises(suzie.web.HTTPError) as cm:
+            self.loop.run_until_complete(server._handle(req))
+        self.assertEqual(cm.exception.status, 400)
+
+        def close_code(*frames, mask=b'abcd'):
+            reader = asyncio.StreamReader(loop=self.loop)
+            for (fin, opcode, payload) in frames:
+                data = suzie.web.encode_frame(opcode, payload, mask=mask)
+                if not fin:
+                    data = bytes([data[0] & 0x7F]) + data[1:]
+                reader.feed_data(data)
+
+            writer = BufferWriter()
+            ws = suzie.web.WebSocket(reader, writer)
+            with self.assertRaises(EOFError):
+                self.loop.run_until_complete(ws.recv())
+            return struct.unpack('!H', bytes(writer.buffer[2:4]))[0]
+
+        self.assertEqual(close_code((True, suzie.web.OP_TEXT, b'\xff')),
+                         1007)
+        chunk = b'x' * 60000
+        self.assertEqual(close_code((False, suzie.web.OP_TEXT, chunk),
+                                    (True, suzie.web.OP_CONT, chunk)),
+                         1009)
+        self.assertEqual(close_code((True, suzie.web.OP_TEXT, b'hi'),
+                                    mask=None),
+                         1002)
+
+    def test_long_poll(self):
+        router = suzie.Router(loop=self.loop)
+        router.load(suzie.plugins.Addition)
+        server = suzie.web.WebServer('127.0.0.1', 0, router=router,
+                                     loop=self.loop)
+        frames = []
+
+        def request(writer, method, path, body=b''):
+            head = '{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'
+            writer.write(head.format(method, path, len(body)).encode() + body)
+
+        async def response(reader):
+            await reader.readuntil(b'Content-Length: ')
+            length = int(await reader.readline())
+            await reader.readuntil(b'\r\n\r\n')
+            return json.loads(await reader.readexactly(length))
+
+        async def scenario():
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+            request(writer, 'POST', '/sessions')
+            path = '/sessions/' + (await response(reader))['session']
+            for text in [b'add', b'1', b'2']:
+                request(writer, 'POST', path, text)
+                await response(reader)
+                request(writer, 'GET', path + '?timeout=1')
+                frames.extend(await response(reader))
+
+            writer.close()
+            server.close()
+            await router.shutdown(timeout=0)
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual([f['type'] for f in frames],
+                         ['prompt', 'prompt', 'close'])
+        self.assertTrue(frames[-1]['text'].endswith(' = 3'))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_ttl_and_lru(self):
+        now = [0]
+        c = suzie.cache.ResultCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        self.assertRaises(KeyError, c.get, 'b')
+        self.assertEqual(c.get('a'), 1)
+
+        now[0] = 10
+        self.assertRaises(KeyError, c.get, 'a')
+
+    def test_single_flight(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        c = suzie.cache.ResultCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        async def scenario():
+            return await asyncio.gather(*[
+                c.call_async('key', fetch) for _ in range(5)])
+
+        self.assertEqual(loop.run_until_complete(scenario()), ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((c.hits, c.misses), (4, 1))
+
+    def test_single_flight_leader_cancelled(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        c = suzie.cache.ResultCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        async def scenario():
+            leader = loop.create_task(c.call_async('key', fetch))
+            await asyncio.sleep(0)
+            waiters = [loop.create_task(c.call_async('key', fetch))
+                       for _ in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            results = await asyncio.gather(*waiters)
+            return leader.cancelled(), results
+
+        self.assertEqual(loop.run_until_complete(scenario()),
+                         (True, ['value'] * 3))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(c.get('key'), 'value')
+
+    def test_weather_is_memoized(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        weather = suzie.plugins.Weather()
+        fetches = []
+
+        def fetch(when):
+            fetches.append(when)
+            return homelib.aemet.Probability.NO
+        weather._fetch = fetch
+
+        router = suzie.Router(loop=loop, plugins=[weather])
+        uis = [ScriptedUI(['lloverá hoy?'], hold=False) for _ in range(3)]
+        for ui in uis:
+            router.add_ui(ui)
+        loop.run_until_complete(router.wait_closed())
+
+        self.assertEqual([ui.received for ui in uis], [['No']] * 3)
+        self.assertEqual(fetches, [homelib.aemet.When.TODAY])
+
+
+class Hanging(suzie.SlottedPlugin):
+    TRIGGERS = [r'^hang$']
+    SLOTS = ['x']
+    TIMEOUT = 0.01
+
+    def setup(self, context, **params):
+        super().setup(context, x='x')
+
+    def extract_slot(self, slot, text):
+        return text
+
+    def validate_slot(self, slot, text):
+        return text
+
+    async def main(self, ctx, x):
+        await asyncio.sleep(10)
+
+
+class Stuck(Hanging):
+    TRIGGERS = [r'^stuck$']
+    TIMEOUT = None
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_states(self):
+        now = [0]
+        cb = suzie.breaker.CircuitBreaker(threshold=2, reset_timeout=5,
+                                          clock=lambda: now[0])
+        cb.failure()
+        self.assertTrue(cb.allow())
+        cb.failure()
+        self.assertEqual(cb.state, cb.OPEN)
+        self.assertFalse(cb.allow())
+
+        now[0] = 5
+        self.assertTrue(cb.allow())
+        self.assertFalse(cb.allow())
+        cb.success()
+        self.assertEqual(cb.state, cb.CLOSED)
+
+    def test_cancelled_trial(self):
+        loop = suzie.testing.VirtualTimeLoop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[Stuck()], linger=True,
+                              timeout=3600, breaker_threshold=1,
+                              breaker_reset=5)
+        cb = router.breaker(next(iter(router.registry)))
+        cb.failure()
+
+        async def scenario():
+            await asyncio.sleep(5)
+            ui = suzie.testing.MemoryUI(['stuck'], close=False)
+            router.add_ui(ui)
+            await asyncio.sleep(1)
+            trial = cb.state, cb._trial
+            router._ui_tasks[ui].cancel()
+            await asyncio.sleep(0)
+            await router.shutdown()
+            return trial
+
+        self.assertEqual(loop.run_until_complete(scenario()),
+                         (cb.HALF_OPEN, True))
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+        self.assertTrue(cb.allow())
+
+    def test_deadline_trips_breaker(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        router = suzie.Router(loop=loop, plugins=[Hanging()],
+                              breaker_threshold=2)
+        router.logger.disabled = True
+        self.addCleanup(setattr, router.logger, 'disabled', False)
+        ui = ScriptedUI(['hang'] * 3, hold=False)
+        router.add_ui(ui)
+        loop.run_until_complete(router.wait_closed())
+
+        self.assertEqual(ui.received, [Hanging.FALLBACK] * 3)
+        stats = router.stats()['plugins']['Hanging']['breaker']
+        self.assertEqual(stats['state'], 'open')
+        self.assertEqual(stats['rejected'], 1)
+
+
+class StalledUI(suzie.testing.MemoryUI):
+    """
+    Client that never reads what it is sent
+    """
+    async def send(self, message):
+        await asyncio.get_running_loop().create_future()
+
+
+class TestScheduling(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0]
+        bucket = suzie.scheduler.TokenBucket(rate=1, burst=2,
+                                             clock=lambda: now[0])
+        self.assertEqual([bucket.consume() for _ in range(3)],
+                         [True, True, False])
+        now[0] = 1
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_round_robin(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        sched = suzie.scheduler.FairScheduler(max_inflight=1, loop=loop)
+        order = []
+
+        async def work(session):
+            async with sched.slot(session):
+                order.append(session)
+                await asyncio.sleep(0)
+
+        async def scenario():
+            await sched.acquire('busy')
+            tasks = [loop.create_task(work(s))
+                     for s in ['a', 'a', 'a', 'b', 'c']]
+            await asyncio.sleep(0)
+            sched.release()
+            await asyncio.gather(*tasks)
+
+        loop.run_until_complete(scenario())
+        self.assertEqual(order, ['a', 'b', 'c', 'a', 'a'])
+
+    def test_session_rate_limit(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()],
+                              session_rate=(0.001, 2))
+        ui = ScriptedUI(['ping'] * 4, hold=False)
+        router.add_ui(ui)
+        loop.run_until_complete(router.wait_closed())
+
+        self.assertEqual(ui.received[:2], ['pong', 'pong'])
+        self.assertEqual(router.rate_limited, 2)
+
+    def test_slow_reader_keeps_no_slot(self):
+        loop = suzie.testing.VirtualTimeLoop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()],
+                              linger=True, max_inflight=1)
+        stalled = StalledUI(['ping'], close=False)
+        other = suzie.testing.MemoryUI(['ping'], close=False)
+
+        async def scenario():
+            router.add_ui(stalled)
+            await asyncio.sleep(1)
+            router.add_ui(other)
+            await other.wait_output(1)
+            inflight = router.scheduler.inflight
+            await router.shutdown(timeout=0)
+            return inflight
+
+        self.assertEqual(loop.run_until_complete(scenario()), 0)
+        self.assertEqual(other.replies, ['pong'])
+
+
+class TestNoteStore(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'notes.log')
+
+    def store(self, **kwargs):
+        return homelib.notes.NoteStore(self.path, loop=self.loop, **kwargs)
+
+    def test_group_commit_and_index(self):
+        store = self.store()
+        writes = []
+        write = store._write
+        store._write = lambda batch: (writes.append(len(batch)),
+                                      write(batch))
+
+        async def scenario():
+            texts = ['comprar pan', 'comprar leche', 'llamar a pepe']
+            await asyncio.gather(*[store.add('me', text) for text in texts])
+            await store.add('other', 'comprar pan')
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual(writes, [3, 1])
+        self.assertEqual([n.text for n in store.search('me', 'Comprar')],
+                         ['comprar leche', 'comprar pan'])
+        self.assertEqual([n.text for n in store.recent('me', 1)],
+                         ['llamar a pepe'])
+
+        reopened = self.store()
+        self.assertEqual(reopened.notes, store.notes)
+
+    def test_compaction(self):
+        store = self.store(compact_min=2)
+
+        async def scenario():
+            notes = [await store.add('me', str(i)) for i in range(4)]
+            for note in notes[:3]:
+                await store.delete('me', note.id)
+            await store.flush()
+
+        self.loop.run_until_complete(scenario())
+
+        with open(self.path) as fh:
+            self.assertEqual(len(fh.readlines()), 1)
+        self.assertEqual([n.text for n in self.store().recent('me')], ['3'])
+
+    def test_failed_write_is_not_indexed(self):
+        store = self.store()
+
+        def write(batch):
+            raise OSError('disk full')
+
+        store._write = write
+
+        async def scenario():
+            with self.assertRaises(OSError):
+                await store.add('me', 'comprar pan')
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual(store.notes, {})
+        self.assertEqual(store.search('me', 'pan'), [])
+        self.assertEqual(store.recent('me'), [])
+
+    def test_notes_need_identity(self):
+        self.addCleanup(setattr, suzie.plugins, 'NOTES_PATH',
+                        suzie.plugins.NOTES_PATH)
+        suzie.plugins.NOTES_PATH = self.path
+        self.addCleanup(homelib.notes._stores.pop,
+                        os.path.abspath(self.path), None)
+
+        async def scenario():
+            router = suzie.Router(loop=self.loop, linger=True, plugins=[
+                suzie.plugins.Notes(), suzie.plugins.NoteSearch(),
+                suzie.plugins.RecentNotes()])
+            uis = [suzie.testing.MemoryUI(['anota comprar pan', 'notas'],
+                                          identity=identity)
+                   for identity in ['ana', 'bea', None]]
+            for ui in uis:
+                router.add_ui(ui)
+                await ui.wait_output(2)
+            await router.shutdown()
+            return uis
+
+        ana, bea, anonymous = self.loop.run_until_complete(scenario())
+
+        self.assertEqual(ana.replies, ['Got your note: comprar pan',
+                                       '#1 comprar pan'])
+        self.assertEqual(bea.replies, ['Got your note: comprar pan',
+                                       '#2 comprar pan'])
+        self.assertEqual(anonymous.replies, [suzie.plugins.NO_IDENTITY] * 2)
+
+    def test_reminders_armed_once(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.addCleanup(suzie.plugins._reminders.clear)
+        timers = suzie.timers.TimerQueue(loop)
+
+        class Ctx:
+            def __init__(self, ui):
+                self.ui = ui
+
+            def call_later(self, delay, callback, *args):
+                return timers.call_later(delay, callback, *args)
+
+        now = datetime.datetime(2020, 1, 1, 9)
+        agenda = homelib.agenda.Agenda()
+        appts = [loop.run_until_complete(agenda.add(
+            'me', now + datetime.timedelta(hours=i + 1),
+            now + datetime.timedelta(hours=i + 2), 'x', 'y'))
+            for i in range(10)]
+
+        first = Ctx(suzie.testing.MemoryUI([]))
+        for _ in range(5):
+            suzie.plugins._arm_reminders(first, appts, now)
+        self.assertEqual(len(timers), 10)
+        self.assertEqual(len(timers._heap), 10)
+
+        second = Ctx(suzie.testing.MemoryUI([]))
+        suzie.plugins._arm_reminders(second, appts[:5], now)
+        self.assertEqual(len(timers), 10)
+        self.assertTrue(all(suzie.plugins._reminders[a][0] is second.ui
+                            for a in appts[:5]))
+
+
+class TestAgenda(unittest.TestCase):
+    def test_queries(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ag = homelib.agenda.Agenda()
+        day = datetime.datetime(2020, 1, 1)
+        h = datetime.timedelta(hours=1)
+
+        def add(*args, **kwargs):
+            return loop.run_until_complete(ag.add(*args, **kwargs))
+
+        long_one = add('me', day, day + 5 * h, 'long', 'here')
+        short = add('me', day + 6 * h, day + 7 * h, 'short', 'there')
+        add('other', day + 6 * h, day + 7 * h, 'theirs', 'there')
+
+        with self.assertRaises(homelib.agenda.ConflictError) as cm:
+            add('me', day + 4 * h, day + 6 * h + h / 2, 'x', 'y')
+        self.assertEqual(cm.exception.conflicts, [long_one, short])
+
+        self.assertEqual(ag.between('me', day + 3 * h, day + 4 * h),
+                         [long_one])
+        self.assertEqual(ag.upcoming('me', day + h), [short])
+
+        loop.run_until_complete(ag.remove(long_one.id))
+        self.assertEqual(ag.between('me', day, day + 5 * h), [])
+
+        week = add('me', day - 24 * 7 * h, day + 24 * 7 * h, 'trip', '',
+                   allow_conflicts=True)
+        self.assertEqual(ag.between('me', day + 6 * h, day + 7 * h),
+                         [week, short])
+        self.assertEqual(ag.upcoming('me', day - 24 * 8 * h), [week])
+
+    def test_log(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'agenda.log')
+        day = datetime.datetime(2020, 1, 1)
+        h = datetime.timedelta(hours=1)
+
+        ag = homelib.agenda.Agenda(path, loop=loop, compact_min=4)
+        writes = []
+        write = ag._write
+        ag._write = lambda batch: (writes.append(len(batch)), write(batch))
+
+        async def scenario():
+            appts = await asyncio.gather(*[
+                ag.add('me', day + i * h, day + (i + 1) * h, str(i), '')
+                for i in range(3)])
+            for appt in appts[:2]:
+                await ag.remove(appt.id)
+            await ag.flush()
+
+            def fail(batch):
+                raise OSError('disk full')
+
+            ag._write = fail
+            with self.assertRaises(OSError):
+                await ag.add('me', day, day + h, 'lost', '')
+            with self.assertRaises(OSError):
+                await ag.remove(appts[2].id)
+
+        loop.run_until_complete(scenario())
+
+        self.assertEqual(writes[0], 3)
+        self.assertEqual([a.about for a in ag.appointments.values()], ['2'])
+        with open(path) as fh:
+            # Compacted once deletions were most of it
+            self.assertEqual(len(fh.readlines()), 1)
+        reopened = homelib.agenda.Agenda(path)
+        self.assertEqual(reopened.appointments, ag.appointments)
+        self.assertEqual(reopened.between('me', day, day + 3 * h),
+                         ag.between('me', day, day + 3 * h))
+
+    def test_events_through_router(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'agenda.log')
+        self.addCleanup(setattr, suzie.plugins, 'AGENDA_PATH',
+                        suzie.plugins.AGENDA_PATH)
+        suzie.plugins.AGENDA_PATH = path
+
+        ui, = suzie.testing.converse(
+            [suzie.plugins.Events(), suzie.plugins.Appointments()],
+            suzie.testing.MemoryUI(['añade cita', 'dentist', 'clinic',
+                                    'mañana a las 10', 'citas mañana',
+                                    48 * 3600], identity='me'))
+
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        self.assertEqual(ui.transcript[-3:], [
+            ('close', 'OK. Your appointment: {} 10:00:00 at clinic. '
+                      'Subject: dentist'.format(tomorrow)),
+            ('close', '{} 10:00 dentist (clinic)'.format(tomorrow)),
+            ('push', 'Reminder: dentist at 10:00 in clinic')])
+
+        self.assertEqual(len(homelib.agenda.Agenda(path)), 1)
+
+    def test_agenda_per_identity(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(setattr, suzie.plugins, 'AGENDA_PATH',
+                        suzie.plugins.AGENDA_PATH)
+        suzie.plugins.AGENDA_PATH = os.path.join(tmpdir, 'agenda.log')
+
+        plugins = [suzie.plugins.Events(), suzie.plugins.Appointments()]
+        ana, = suzie.testing.converse(plugins, suzie.testing.MemoryUI(
+            ['añade cita', 'dentist', 'clinic', 'mañana a las 10'],
+            user='anonymous', identity='ana'), drain=0)
+        bea, anonymous = suzie.testing.converse(
+            plugins,
+            suzie.testing.MemoryUI(['citas mañana', 'próxima cita'],
+                                   user='anonymous', identity='bea'),
+            suzie.testing.MemoryUI(['citas mañana', 'añade cita'],
+                                   user='anonymous'),
+            drain=0)
+
+        self.assertTrue(ana.replies[-1].startswith('OK. Your appointment'))
+        self.assertEqual(bea.replies, ['Nothing', 'Nothing'])
+        self.assertEqual(anonymous.replies, [suzie.plugins.NO_IDENTITY] * 2)
+
+
+class TestTimerQueue(unittest.TestCase):
+    def test_order_and_cancel(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tq = suzie.timers.TimerQueue(loop)
+        fired = []
+
+        for delay in [0.03, 0.01, 0.02]:
+            tq.call_later(delay, fired.append, delay)
+        tq.call_later(0.015, fired.append, 'cancelled').cancel()
+        tq.call_later(0.04, loop.stop)
+
+        loop.run_forever()
+        self.assertEqual(fired, [0.01, 0.02, 0.03])
+        self.assertEqual(len(tq), 0)
+
+    def test_tombstones(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tq = suzie.timers.TimerQueue(loop)
+
+        timers = [tq.call_later(60 + i, print) for i in range(100)]
+        for timer in timers[:40]:
+            timer.cancel()
+        timers[0].cancel()
+        self.assertEqual(len(tq), 60)
+        self.assertEqual(len(tq._heap), 100)
+
+        for timer in timers[40:60]:
+            timer.cancel()
+        self.assertEqual(len(tq), 40)
+        self.assertLess(len(tq._heap), 80)
+        self.assertEqual(tq.next_when(), timers[60].when)
+
+        tq.cancel_all()
+        self.assertEqual(len(tq), 0)
+
+
+class BufferWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 0) if name == 'peername' else None
+
+    def lines(self):
+        return self.buffer.decode('utf-8').splitlines()
+
+
+class TestMultiplexer(unittest.TestCase):
+    def test_pipelined_conversations(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[
+            suzie.plugins.Ping(), suzie.plugins.Addition()])
+
+        reader = asyncio.StreamReader(loop=loop)
+        writer = BufferWriter()
+        reader.feed_data(b'REQ 1 a add\n'
+                         b'REQ 2 b ping\n'
+                         b'REQ 3 a 4\n'
+                         b'bogus\n'
+                         b'REQ 4 a 5\n'
+                         b'END b\n')
+        reader.feed_eof()
+
+        mux = suzie.ui.Multiplexer(reader, writer, router.add_ui)
+        loop.create_task(mux.run())
+        loop.run_until_complete(router.wait_closed())
+
+        lines = writer.lines()
+        self.assertEqual(lines[0], 'MUX OK')
+        self.assertIn('CLOSE 2 pong', lines)
+        self.assertIn('ERR Malformed frame', lines)
+        self.assertEqual([line.split(' ', 2)[:2] for line in lines
+                          if line.split(' ')[1] in '134'],
+                         [['PROMPT', '1'], ['PROMPT', '3'], ['CLOSE', '4']])
+        self.assertIn('END a', lines)
+        self.assertIn('END b', lines)
+
+    def test_connection_limits(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()],
+                              session_rate=(0.001, 3), linger=True)
+
+        reader = asyncio.StreamReader(loop=loop)
+        writer = BufferWriter()
+        reader.feed_data(b''.join(
+            'REQ {} {} ping\n'.format(i, 'abcd'[i % 4]).encode('utf-8')
+            for i in range(5)))
+        reader.feed_eof()
+
+        mux = suzie.ui.Multiplexer(reader, writer, router.add_ui)
+        mux.MAX_CHANNELS = 3
+        mux.MAX_PENDING = 1
+
+        async def scenario():
+            await mux.run()
+            # Every conversation finished before run() returned
+            lines = writer.lines()
+            await router.shutdown()
+            return lines
+
+        lines = loop.run_until_complete(scenario())
+
+        self.assertEqual(sorted(line for line in lines
+                                if line.endswith('pong')),
+                         ['CLOSE 0 pong', 'CLOSE 1 pong', 'CLOSE 2 pong'])
+        self.assertEqual(lines.count('ERR 3 Too many conversations'), 1)
+        self.assertEqual(lines.count('ERR 4 Too many pending requests'), 1)
+        self.assertEqual(sorted(line for line in lines
+                                if line.startswith('END')),
+                         ['END a', 'END b', 'END c'])
+        self.assertEqual(mux.channels, {})
+
+    def test_shared_rate_limit(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()],
+                              session_rate=(0.001, 2), linger=True)
+
+        reader = asyncio.StreamReader(loop=loop)
+        writer = BufferWriter()
+        reader.feed_data(b''.join(
+            'REQ {0} c{0} ping\n'.format(i).encode('utf-8')
+            for i in range(4)))
+        reader.feed_eof()
+
+        mux = suzie.ui.Multiplexer(reader, writer, router.add_ui)
+
+        async def scenario():
+            await mux.run()
+            await router.shutdown()
+
+        loop.run_until_complete(scenario())
+
+        pongs = [line for line in writer.lines() if line.endswith('pong')]
+        self.assertEqual(len(pongs), 2)
+        self.assertEqual(router.rate_limited, 2)
+        self.assertEqual(router._session_buckets, {})
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_reads_from_daemon_thread(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        lines = iter(['  ping   me ', 'bye'])
+        prompts = []
+
+        def fake_input(prompt):
+            prompts.append(prompt)
+            return next(lines)
+
+        suzie.ui.input = fake_input
+        self.addCleanup(delattr, suzie.ui, 'input')
+
+        async def scenario():
+            ui = suzie.ui.CommandLine()
+            text = await ui.recv()
+            with self.assertRaises(EOFError):
+                await ui.recv()
+            return text
+
+        self.assertEqual(loop.run_until_complete(scenario()), 'ping me')
+        self.assertEqual(prompts, ['> ', '> '])
+        reader, = [t for t in threading.enumerate()
+                   if t.name == 'suzie-stdin']
+        self.assertTrue(reader.daemon)
+
+
+class TestLoops(unittest.TestCase):
+    def test_loop_factory(self):
+        self.assertIn('asyncio', suzie.loops.available())
+
+        loop = suzie.loops.loop_factory('asyncio')()
+        self.addCleanup(loop.close)
+        self.assertIsInstance(loop, asyncio.AbstractEventLoop)
+
+        self.assertRaises(ValueError, suzie.loops.loop_factory, 'nope')
+
+
+class Backtracking(suzie.Plugin):
+    TRIGGERS = [r'^(a+)+$']
+
+
+class TestTriggers(unittest.TestCase):
+    def test_analyze(self):
+        severities = suzie.triggers.analyze(r'(\s*\w+)*$')
+        self.assertIn(suzie.triggers.EXPONENTIAL, [s for (s, _) in severities])
+        self.assertEqual(suzie.triggers.analyze(r'\d+\d+')[0][0],
+                         suzie.triggers.POLYNOMIAL)
+        self.assertEqual(suzie.triggers.analyze(r'^(\w+)\s+(\d+)$'), [])
+
+        # Bounded outer repeats, and inner quantifiers followed by more of
+        # the body
+        for pattern in (r'(.*a){12}x', r'(a+){2,5}b', r'(.*a)*x'):
+            self.assertEqual(suzie.triggers.analyze(pattern),
+                             [(suzie.triggers.EXPONENTIAL,
+                               'nested quantifiers')])
+        for pattern in (r'(a+b){12}', r'(a+)?b', r'^(\d+,)*$'):
+            self.assertEqual(suzie.triggers.analyze(pattern), [])
+
+        # Prefixes factored out of the alternatives by the parser
+        for pattern in (r'^(a|aa)+$', r'(a|ab)*'):
+            self.assertEqual(suzie.triggers.analyze(pattern),
+                             [(suzie.triggers.EXPONENTIAL,
+                               'overlapping alternatives under a quantifier')])
+        self.assertEqual(suzie.triggers.analyze(r'^(foo|bar)+$'), [])
+
+        self.assertRaises(suzie.exc.UnsafeTrigger, Backtracking)
+
+    def test_match_budget(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, plugins=[suzie.plugins.Ping()],
+                              max_input=8)
+        router.logger.disabled = True
+        self.addCleanup(setattr, router.logger, 'disabled', False)
+
+        self.assertEqual(len(list(router.get_handlers('ping'))), 1)
+        self.assertEqual(list(router.get_handlers('ping' * 3)), [])
+
+        router.max_input = None
+        router.match_budget = -1
+        self.assertEqual(list(router.get_handlers('ping')), [])
+        self.assertEqual(router.stats()['match_overruns'], 2)
+
+
+class TestVirtualTime(unittest.TestCase):
+    def test_timers_and_pushes(self):
+        loop = suzie.testing.VirtualTimeLoop()
+        self.addCleanup(loop.close)
+
+        ui, = suzie.testing.converse([suzie.plugins.Alarm()],
+                                     ['beep in 3600', 3601], loop=loop)
+        self.assertEqual(ui.transcript,
+                         [('close', 'OK. I will beep in 3600'),
+                          ('push', 'Wakeup after 3600')])
+        self.assertGreaterEqual(loop.time(), 3600)
+
+    def test_deadline(self):
+        ui, = suzie.testing.converse([Hanging()], ['hang', 'hang'])
+        self.assertEqual(ui.replies, [Hanging.FALLBACK] * 2)
+
+    def test_generated_conversations(self):
+        scripts = [['ping', '{} + {}'.format(i, i), 'add', str(i), '1']
+                   for i in range(500)]
+        uis = suzie.testing.converse(
+            [suzie.plugins.Ping(), suzie.plugins.Addition()], *scripts)
+
+        for (i, ui) in enumerate(uis):
+            self.assertEqual(ui.replies, [
+                'pong', '{i} + {i} = {z}'.format(i=i, z=2 * i),
+                'Give x', 'Give y', '{} + 1 = {}'.format(i, i + 1)])
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        time.sleep(0.01)
+        self.records.append(record)
+
+
+class Chatty(suzie.Plugin):
+    TRIGGERS = [r'^chat$']
+
+    def handle(self, context, message):
+        self.logger.warning('chatting')
+        return suzie.ClosingMessage('ok')
+
+
+class TestLogging(unittest.TestCase):
+    def test_pipeline(self):
+        handler = SlowHandler()
+        suzie.logs.install(handlers=[handler], debug_rate=None)
+        self.addCleanup(suzie.logs.uninstall)
+
+        t0 = time.perf_counter()
+        suzie.testing.converse([Chatty()], ['chat'] * 20)
+        self.assertLess(time.perf_counter() - t0, 0.1)
+
+        suzie.logs.uninstall()
+        self.assertEqual(len(handler.records), 20)
+        self.assertEqual({(r.session, r.plugin) for r in handler.records},
+                         {('test#1', 'Chatty')})
+
+    def test_debug_rate_limit(self):
+        now = [0]
+        f = suzie.logs.DebugRateLimit(rate=1, burst=2, clock=lambda: now[0])
+        records = [logging.LogRecord('x', level, __file__, 0, 'm', (), None)
+                   for level in [logging.DEBUG] * 3 + [logging.ERROR]]
+
+        self.assertEqual([f.filter(r) for r in records],
+                         [True, True, False, True])
+        self.assertEqual(f.suppressed, 1)
+
+
+class TestSharedSessions(unittest.TestCase):
+    def test_hash_ring(self):
+        ring = suzie.kv.HashRing(['a', 'b', 'c'])
+        keys = ['session-{}'.format(i) for i in range(3000)]
+        before = {k: ring.node_for(k) for k in keys}
+        self.assertGreater(min(collections.Counter(before.values()).values()),
+                           700)
+
+        ring.add('d')
+        moved = [k for k in keys if ring.node_for(k) != before[k]]
+        self.assertTrue(all(ring.node_for(k) == 'd' for k in moved))
+        self.assertLess(len(moved), 1100)
+
+    def test_conversation_moves_between_nodes(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        a, b = [suzie.testing.MemoryUI(close=False, session_id='s1')
+                for _ in range(2)]
+
+        async def scenario():
+            servers = [suzie.kv.KVServer('127.0.0.1', 0, loop=loop)
+                       for _ in range(2)]
+            nodes = {}
+            for (i, server) in enumerate(servers):
+                await server.listen()
+                port = server.server.sockets[0].getsockname()[1]
+                nodes['kv{}'.format(i)] = ('127.0.0.1', port)
+
+            routers = [
+                suzie.Router(loop=loop, plugins=[suzie.plugins.Addition()],
+                             linger=True,
+                             sessions=suzie.kv.SessionStore(nodes, loop=loop))
+                for _ in range(2)]
+            routers[0].add_ui(a)
+            routers[1].add_ui(b)
+
+            a.say('add', '2')
+            await a.wait_output(2)
+            b.say('3')
+            await b.wait_output(1)
+            # Invalidations are delivered asynchronously
+            await asyncio.sleep(0.05)
+            a.say('4')
+            await a.wait_output(3)
+
+            for (router, ui) in zip(routers, [a, b]):
+                ui.close()
+                await router.shutdown()
+                router.sessions.close()
+            for server in servers:
+                server.close()
+            await asyncio.sleep(0)
+
+            return routers[0].sessions.stats()
+
+        stats = loop.run_until_complete(scenario())
+
+        self.assertEqual(a.replies, ['Give x', 'Give y',
+                                     "[?] I don't how to handle that"])
+        self.assertEqual(b.replies, ['2 + 3 = 5'])
+        self.assertGreater(sum(n['hits'] for n in stats.values()), 0)
+
+    def test_unshareable_state(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ui = suzie.testing.MemoryUI(close=False, session_id='s1')
+
+        async def scenario():
+            server = suzie.kv.KVServer('127.0.0.1', 0, loop=loop)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            store = suzie.kv.SessionStore({'kv': ('127.0.0.1', port)},
+                                          loop=loop)
+            router = suzie.Router(loop=loop, plugins=[Remember()],
+                                  linger=True, sessions=store)
+            router.logger.disabled = True
+            self.addCleanup(setattr, router.logger, 'disabled', False)
+            router.add_ui(ui)
+
+            ui.say('remember date')
+            await ui.wait_output(1)
+            shared = await store.load('s1')
+            ui.say('')
+            await ui.wait_output(2)
+
+            ui.say('remember opaque')
+            await ui.wait_output(3)
+            local = await store.load('s1')
+            ui.say('')
+            await ui.wait_output(4)
+
+            ui.close()
+            await router.shutdown()
+            store.close()
+            server.close()
+            await asyncio.sleep(0)
+            return shared, local
+
+        shared, local = loop.run_until_complete(scenario())
+
+        self.assertEqual(shared['memory']['when'], datetime.date(2024, 2, 29))
+        self.assertIsNone(local)
+        self.assertEqual(ui.replies[:3],
+                         ['When?', 'datetime.date(2024, 2, 29)', 'When?'])
+        self.assertTrue(ui.replies[3].startswith('<object object'))
+
+    def test_request_encoding_error(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def scenario():
+            server = suzie.kv.KVServer('127.0.0.1', 0, loop=loop)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            client = suzie.kv.KVClient('127.0.0.1', port, loop=loop)
+            with self.assertRaises(TypeError):
+                await client.set('k', object())
+            pending = len(client._pending)
+            client.close()
+            server.close()
+            await asyncio.sleep(0)
+            return pending
+
+        self.assertEqual(loop.run_until_complete(scenario()), 0)
+
+
+class Remember(suzie.Plugin):
+    TRIGGERS = [r'^remember (?P<what>\w+)$']
+
+    def setup(self, context, what):
+        context.memory['what'] = what
+
+    def handle(self, context, message):
+        if 'when' not in context.memory:
+            context.memory['when'] = {
+                'date': datetime.date(2024, 2, 29),
+                'opaque': object()}[context.memory['what']]
+            return suzie.Message('When?')
+
+        return suzie.ClosingMessage(repr(context.memory['when']))
+
+
+class Slow(suzie.SlottedPlugin):
+    TRIGGERS = [r'^slow (?P<n>\d+)$']
+    SLOTS = ['n']
+
+    def extract_slot(self, slot, text):
+        return text
+
+    def validate_slot(self, slot, value):
+        return int(value)
+
+    async def main(self, ctx, n):
+        await asyncio.sleep(0)
+        return str(sum(i * i for i in range(n)))
+
+
+class CachedSlow(Slow):
+    TRIGGERS = [r'^cached (?P<n>\d+)$']
+    CACHE_TTL = 60
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.router = suzie.Router(loop=self.loop, linger=True,
+                                   plugins=[Slow(), CachedSlow(),
+                                            suzie.plugins.Ping()])
+
+    def test_plugin_deterministic(self):
+        plugin = next(p for p in self.router.registry if p.NAME == 'Slow')
+        profiler = suzie.profiler.Profiler(self.router)
+        ui = suzie.testing.MemoryUI(['ping'] + ['slow 10000'] * 5)
+
+        async def scenario():
+            profiling = self.loop.create_task(
+                profiler.profile('Slow', 0.2, 'deterministic'))
+            await asyncio.sleep(0)
+            self.router.add_ui(ui)
+            report = await profiling
+            await self.router.shutdown()
+            return report
+
+        report = self.loop.run_until_complete(scenario())
+
+        self.assertEqual(len(ui.replies), 6)
+        self.assertIn('(main)', report)
+        self.assertNotIn('(recv)', report)
+        self.assertNotIn('main', plugin.__dict__)
+
+    def test_cached_plugin(self):
+        plugin = next(p for p in self.router.registry
+                      if p.NAME == 'CachedSlow')
+        profiler = suzie.profiler.Profiler(self.router)
+        during = suzie.testing.MemoryUI(['cached 10'] * 2)
+        after = suzie.testing.MemoryUI(['cached 10'])
+
+        async def scenario():
+            profiling = self.loop.create_task(
+                profiler.profile('CachedSlow', 0.1, 'deterministic'))
+            await asyncio.sleep(0)
+            self.router.add_ui(during)
+            report = await profiling
+            self.router.add_ui(after)
+            await self.router.shutdown()
+            return report
+
+        report = self.loop.run_until_complete(scenario())
+
+        self.assertEqual(during.replies, ['285', '285'])
+        self.assertEqual(after.replies, ['285'])
+        self.assertIn('(main)', report)
+        self.assertIsNotNone(plugin.cache)
+
+    def test_plugin_sampling(self):
+        # CachedSlow runs the main() it inherits from Slow: only its own
+        # samples count
+        profiler = suzie.profiler.Profiler(self.router, interval=0.0005,
+                                           top=100)
+
+        async def scenario():
+            reports = []
+            for (i, name) in enumerate(['Slow', 'CachedSlow']):
+                profiling = self.loop.create_task(
+                    profiler.profile(name, 0.3, 'sampling'))
+                await asyncio.sleep(0)
+                self.router.add_ui(suzie.testing.MemoryUI(
+                    ['cached {}'.format(300000 + 10 * i + j)
+                     for j in range(5)]))
+                reports.append(await profiling)
+            await self.router.shutdown()
+            return reports
+
+        slow, cached = self.loop.run_until_complete(scenario())
+
+        self.assertTrue(slow.startswith('0 samples'), slow)
+        self.assertFalse(cached.startswith('0 samples'), cached)
+        self.assertIn('(main)', cached)
+
+    def test_admin_session(self):
+        async def scenario():
+            server = suzie_main.TCPServer('127.0.0.1', 0, self.router,
+                                          loop=self.loop, admin=True)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'ADMIN\nprofile router 0.05\nprofile Nope 1\n')
+
+            replies = []
+            for _ in range(2):
+                lines = []
+                while True:
+                    line = (await reader.readline()).decode('utf-8')
+                    if line == '.\n':
+                        break
+                    lines.append(line)
+                replies.append(''.join(lines))
+
+            writer.close()
+            server.close()
+            await self.router.shutdown()
+            return replies
+
+        report, error = self.loop.run_until_complete(scenario())
+
+        self.assertIn('samples every', report)
+        self.assertTrue(error.startswith('ERR LookupError'))
+
+    def test_admin_profile_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outside = os.path.join(os.path.dirname(tmpdir), 'outside.txt')
+
+        async def scenario(profile_dir):
+            server = suzie_main.TCPServer('127.0.0.1', 0, self.router,
+                                          loop=self.loop, admin=True,
+                                          profile_dir=profile_dir)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'ADMIN\n')
+            replies = []
+            for name in ('report.txt', '../outside.txt', outside):
+                writer.write('profile router 0.01 sampling {}\n'.format(
+                    name).encode('utf-8'))
+                replies.append((await reader.readuntil(b'.\n')).decode())
+
+            writer.close()
+            server.close()
+            return replies
+
+        written, *escapes = self.loop.run_until_complete(scenario(tmpdir))
+        self.assertTrue(written.startswith('Written to'))
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'report.txt')))
+        for reply in escapes:
+            self.assertTrue(reply.startswith('ERR ValueError'))
+        self.assertFalse(os.path.exists(outside))
+
+        disabled = self.loop.run_until_complete(scenario(None))
+        for reply in disabled:
+            self.assertTrue(reply.startswith('ERR ValueError'))
+        self.loop.run_until_complete(self.router.shutdown())
+
+
+class TestSessionFootprint(unittest.TestCase):
+    def test_push_channel_is_lazy(self):
+        loop = suzie.testing.VirtualTimeLoop()
+        self.addCleanup(loop.close)
+        router = suzie.Router(loop=loop, linger=True,
+                              plugins=[suzie.plugins.Ping(),
+                                       suzie.plugins.Alarm()])
+        idle = suzie.testing.MemoryUI(['ping'], close=False)
+        beeping = suzie.testing.MemoryUI(['beep in 1', 2], close=False)
+
+        async def scenario():
+            router.add_ui(idle)
+            router.add_ui(beeping)
+            await beeping.wait_output(2)
+            tasks = len(asyncio.all_tasks())
+            channels = [router._push_queues[ui]._queue for ui in (idle,
+                                                                  beeping)]
+            await router.shutdown()
+            return tasks, channels
+
+        tasks, (idle_queue, beeping_queue) = loop.run_until_complete(
+            scenario())
+
+        # scenario, two sessions and one push delivery task
+        self.assertEqual(tasks, 4)
+        self.assertIsNone(idle_queue)
+        self.assertIsNotNone(beeping_queue)
+
+    def test_slotted(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ctx = suzie.Context('test', ui=None, push_queue=None, loop=loop)
+        self.assertFalse(hasattr(ctx, '__dict__'))
+        self.assertFalse(hasattr(suzie.Message('x'), '__dict__'))
+        self.assertEqual(suzie.ClosingMessage(), 'Done!')
 
 
 if __name__ == '__main__':